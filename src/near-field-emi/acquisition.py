@@ -0,0 +1,196 @@
+import logging
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from control.SA import calculate_frequencies, parse_spectrum, save_data
+from scan_file import create_scan, is_scan_file, open_scan, point_file_name
+
+logger = logging.getLogger("main")
+
+# points saved by the writer between syncs of the sink while it's busy, the
+# sink is synced after every point once the writer has caught up
+SYNC_EVERY = 16
+
+
+def sync_path(path: str) -> None:
+    # fsync works on read-only descriptors of both files and directories
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class CsvSink:
+    def __init__(
+        self, path_dir: str, start: float, stop: float, traces: Optional[list] = None
+    ):
+        self.path_dir = path_dir
+        self.start = start
+        self.stop = stop
+        self.traces = traces
+        self.unsynced = []
+
+    def __call__(self, x_pos: float, y_pos: float, data: np.ndarray) -> None:
+        path = os.path.join(self.path_dir, point_file_name(x_pos, y_pos))
+        save_data(data, self.start, self.stop, Path(path), self.traces)
+        self.unsynced.append(path)
+
+    def sync(self) -> None:
+        # the files and their directory entries are on disk once this returns
+        if not self.unsynced:
+            return
+        for path in self.unsynced:
+            sync_path(path)
+        sync_path(self.path_dir)
+        self.unsynced = []
+
+    def close(self) -> None:
+        self.sync()
+
+
+class ScanSink:
+    def __init__(
+        self,
+        path: str,
+        x_positions: list,
+        y_positions: list,
+        start: float,
+        stop: float,
+        metadata: dict,
+        append: bool = False,
+        traces: Optional[list] = None,
+    ):
+        self.path = path
+        self.x_positions = x_positions
+        self.y_positions = y_positions
+        self.start = start
+        self.stop = stop
+        self.metadata = metadata
+        self.traces = traces
+        self.scan = open_scan(path, "r+") if append and is_scan_file(path) else None
+        self.created = False
+
+    def __call__(self, x_pos: float, y_pos: float, data: np.ndarray) -> None:
+        # the trace length is only known after the first sweep
+        if self.scan is None:
+            self.scan = create_scan(
+                self.path,
+                self.x_positions,
+                self.y_positions,
+                calculate_frequencies(self.start, self.stop, np.shape(data)[-1]),
+                self.metadata,
+                self.traces,
+            )
+            self.created = True
+        self.scan.write_point(x_pos, y_pos, data)
+
+    def sync(self) -> None:
+        # flushing the memory maps writes the dirty pages synchronously
+        if self.scan is None:
+            return
+        self.scan.flush()
+        if self.created:
+            sync_path(os.path.dirname(os.path.abspath(self.path)))
+            self.created = False
+
+    def close(self) -> None:
+        if self.scan is not None:
+            self.scan.close()
+
+
+def parse_blocks(blocks) -> np.ndarray:
+    # a block of a single trace or a list of blocks, one per trace, spectra
+    # which were already parsed are passed on
+    if isinstance(blocks, np.ndarray):
+        return blocks
+    if isinstance(blocks, bytes):
+        return parse_spectrum(blocks)
+    traces = [parse_spectrum(block) for block in blocks]
+    return traces[0] if len(traces) == 1 else np.stack(traces)
+
+
+class PointWriter:
+    # Parses and stores spectra on a background thread, so the plotter can
+    # move to the next point as soon as a trace has been read from the SA. The
+    # queue is bounded, a slow disk eventually blocks the acquisition instead
+    # of growing memory, and closing the writer always drains what's queued.
+    # on_saved is only called for points once the sink has synced them to
+    # disk, in batches while the writer is behind.
+    def __init__(
+        self, sink, max_pending: int = 64, on_saved=None, sync_every=SYNC_EVERY
+    ):
+        self.sink = sink
+        self.on_saved = on_saved
+        self.sync_every = sync_every
+        self.unsynced = []
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+        self.written = 0
+        self.thread = threading.Thread(target=self._run, name="point-writer")
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self._sync()
+                return
+            if self.error is not None:
+                continue
+            x_pos, y_pos, block, record = item
+            try:
+                started = time.monotonic()
+                self.sink(x_pos, y_pos, parse_blocks(block))
+                if record is not None:
+                    record["write"] = time.monotonic() - started
+                self.written += 1
+                self.unsynced.append((x_pos, y_pos, record))
+            except BaseException as e:
+                logger.error("Couldn't save point x:%s y:%s: %s", x_pos, y_pos, e)
+                self.error = e
+                continue
+            if len(self.unsynced) >= self.sync_every or self.queue.empty():
+                self._sync()
+
+    def _sync(self) -> None:
+        if self.error is not None or not self.unsynced:
+            return
+        try:
+            self.sink.sync()
+            if self.on_saved is not None:
+                for x_pos, y_pos, record in self.unsynced:
+                    self.on_saved(x_pos, y_pos, record)
+        except BaseException as e:
+            logger.error("Couldn't sync saved points: %s", e)
+            self.error = e
+        self.unsynced = []
+
+    def _raise_error(self) -> None:
+        if self.error is not None:
+            raise RuntimeError("Saving measurement data failed") from self.error
+
+    def put(
+        self, x_pos: float, y_pos: float, block, record: Optional[dict] = None
+    ) -> None:
+        self._raise_error()
+        self.queue.put((x_pos, y_pos, block, record))
+
+    def close(self) -> None:
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.sink.close()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,141 @@
+import math
+
+import numpy as np
+
+# Adaptive scans measure a coarse grid first and then recursively split the
+# cells whose score is above a threshold. Every point lies on a fine lattice
+# whose pitch is the coarse step divided by a power of two, so the result is
+# stored like a regular scan on the fine grid with only some points captured.
+# The x and y steps may differ, each axis has its own stride and stops being
+# split once it reaches its finest pitch.
+
+# fraction of the best coarse cell's score a cell needs to be refined
+DEFAULT_REFINE_THRESHOLD = 0.3
+
+
+def lattice_stride(step: float, min_step: float) -> int:
+    if min_step <= 0 or min_step >= step:
+        return 1
+    return 2 ** int(math.floor(math.log2(step / min_step)))
+
+
+def point_power(data: np.ndarray, freqs: np.ndarray, units: str = "dBuV") -> float:
+    # power integrated over the whole sweep, on a linear scale
+    data = np.asarray(data, dtype=np.float64)
+    if units.startswith("dB"):
+        linear = 10 ** (data / 10)
+    elif units == "V":
+        linear = data**2
+    else:
+        linear = data
+    return float(np.sum((linear[1:] + linear[:-1]) * np.diff(freqs)) / 2)
+
+
+def score_max_level(corners: np.ndarray) -> np.ndarray:
+    return np.max(corners, axis=-1)
+
+
+def score_gradient(corners: np.ndarray) -> np.ndarray:
+    return np.max(corners, axis=-1) - np.min(corners, axis=-1)
+
+
+score_functions = {
+    "level": score_max_level,
+    "gradient": score_gradient,
+}
+
+
+class AdaptivePlanner:
+    def __init__(
+        self,
+        x_positions: list,
+        y_positions: list,
+        stride: tuple,
+        threshold: float = DEFAULT_REFINE_THRESHOLD,
+        score: str = "gradient",
+    ):
+        # x_positions and y_positions are the axes of the fine lattice, stride
+        # holds the coarse step of each axis in lattice points
+        self.x = list(x_positions)
+        self.y = list(y_positions)
+        if isinstance(stride, int):
+            stride = (stride, stride)
+        self.stride = tuple(stride)
+        self.threshold = threshold
+        self.score = score_functions[score]
+        self.levels = np.full((len(self.x), len(self.y)), np.nan)
+        self.index = {
+            (x_pos, y_pos): (i, j)
+            for i, x_pos in enumerate(self.x)
+            for j, y_pos in enumerate(self.y)
+        }
+        stride_x, stride_y = self.stride
+        self.cells = np.array(
+            [
+                (i, j)
+                for i in range(0, len(self.x) - stride_x, stride_x)
+                for j in range(0, len(self.y) - stride_y, stride_y)
+            ],
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        self.size = np.array(self.stride, dtype=np.int64)
+        self.reference = None
+
+    def _positions(self, indices) -> list:
+        return [(self.x[i], self.y[j]) for i, j in sorted(set(indices))]
+
+    def initial_points(self) -> list:
+        return self._positions(
+            (i, j)
+            for i in range(0, len(self.x), self.stride[0])
+            for j in range(0, len(self.y), self.stride[1])
+        )
+
+    def record(self, x_pos: float, y_pos: float, level: float) -> None:
+        self.levels[self.index[(x_pos, y_pos)]] = level
+
+    def cell_scores(self) -> np.ndarray:
+        i, j = self.cells[:, 0], self.cells[:, 1]
+        size_x, size_y = self.size
+        corners = np.stack(
+            (
+                self.levels[i, j],
+                self.levels[i + size_x, j],
+                self.levels[i, j + size_y],
+                self.levels[i + size_x, j + size_y],
+            ),
+            axis=-1,
+        )
+        return self.score(corners)
+
+    def next_points(self) -> list:
+        if self.size.max() < 2 or len(self.cells) == 0:
+            return []
+        scores = self.cell_scores()
+        # thresholds are relative to the highest score of the coarse grid, so
+        # cells keep being compared against the same scale at every level
+        if self.reference is None:
+            self.reference = np.nanmax(scores) if np.any(scores > 0) else 0.0
+        selected = self.cells[scores >= self.threshold * self.reference]
+        if self.reference == 0.0 or len(selected) == 0:
+            self.cells = self.cells[:0]
+            return []
+        # an axis already at its finest pitch isn't split any further
+        split = self.size >= 2
+        half = np.where(split, self.size // 2, self.size)
+        offsets = [
+            (0, size) if axis_split else (0,) for axis_split, size in zip(split, half)
+        ]
+        children = np.concatenate(
+            [selected + (di, dj) for di in offsets[0] for dj in offsets[1]]
+        )
+        corners = np.unique(
+            np.concatenate(
+                [children + (di, dj) for di in (0, half[0]) for dj in (0, half[1])]
+            ),
+            axis=0,
+        )
+        self.cells = children
+        self.size = half
+        missing = np.isnan(self.levels[corners[:, 0], corners[:, 1]])
+        return self._positions(map(tuple, corners[missing]))
@@ -0,0 +1,149 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+MEASURE = Path(__file__).resolve().parents[1] / "measure.py"
+
+# stages waiting on the simulated hardware, which are scaled back to bench times
+SIMULATED_STAGES = ["motion", "settle", "tune", "sweep", "readout"]
+STAGES = SIMULATED_STAGES + ["write"]
+
+
+def directory_size(path: str) -> int:
+    # allocated bytes, a preallocated sparse scan file only counts what's written
+    return sum(
+        os.stat(os.path.join(path, name)).st_blocks * 512 for name in os.listdir(path)
+    )
+
+
+def read_points(path: str) -> list:
+    with open(os.path.join(path, "journal.jsonl"), encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    return [record for record in records if record["type"] == "point"]
+
+
+def mean_stage_time(points: list, stage: str, scale: float) -> float:
+    total = sum(point.get(stage, 0) for point in points) / len(points)
+    return total / scale if stage in SIMULATED_STAGES else total
+
+
+def point_time(point: dict, scale: float) -> float:
+    # the journaled duration of a point with its simulated stages scaled back,
+    # the host's own time in between is taken as it is
+    simulated = sum(point.get(stage, 0) for stage in SIMULATED_STAGES)
+    return point["duration"] - simulated + simulated / scale
+
+
+def run_scan(size: int, target: str, args) -> None:
+    command = [
+        sys.executable,
+        str(MEASURE),
+        str(size),
+        str(size),
+        "simulated",
+        "simulated",
+        target,
+        "--simulate",
+        "--sim-time-scale",
+        str(args.time_scale),
+        "--step",
+        str(args.step),
+        str(args.step),
+        "--settle",
+        str(args.settle),
+        "--output-format",
+        args.output_format,
+        "--segments",
+        str(args.segments),
+        "--path",
+        args.path,
+    ]
+    subprocess.run(command, check=True, capture_output=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="acquisition benchmark",
+        description="Run measure.py end to end against the simulated plotter and SA and report the throughput of the acquisition.",
+    )
+    parser.add_argument(
+        "-n",
+        "--sizes",
+        type=int,
+        nargs="+",
+        help="Square board sizes in mm to scan. Default is 20 40 60",
+        default=[20, 40, 60],
+    )
+    parser.add_argument(
+        "-s",
+        "--step",
+        type=int,
+        help="Measurement step in mm. Default is 5",
+        default=5,
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        help="Settle time passed to measure.py. Default is 0.5",
+        default=0.5,
+    )
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        help="Simulated delays are multiplied by this factor, times are reported scaled back. Default is 0.1",
+        default=0.1,
+    )
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        choices=["csv", "scan"],
+        help="Output format passed to measure.py. Default is scan",
+        default="scan",
+    )
+    parser.add_argument(
+        "--segments",
+        type=int,
+        help="Number of segments of the sweep passed to measure.py. Default is 1",
+        default=1,
+    )
+    parser.add_argument(
+        "-p",
+        "--path",
+        type=str,
+        help="Path planner passed to measure.py. Default is serpentine",
+        default="serpentine",
+    )
+    args = parser.parse_args()
+    if args.time_scale <= 0:
+        print("Time scale has to be positive to report bench times")
+        sys.exit()
+
+    # stage times are simulated delays scaled back, points per hour follow the
+    # journaled point durations, so the start of measure.py isn't counted
+    scale = args.time_scale
+    header = "".join(f"{stage + ' [s]':>12}" for stage in STAGES)
+    print(f"{'points':>8} {'points/h':>10}{header} {'written':>10}")
+    for size in args.sizes:
+        target = tempfile.mkdtemp(prefix="emi-bench-")
+        try:
+            run_scan(size, target, args)
+            points = read_points(target)
+            elapsed = sum(point_time(point, scale) for point in points)
+            stages = "".join(
+                f"{mean_stage_time(points, stage, scale):>12.3f}" for stage in STAGES
+            )
+            written = directory_size(target) / 2**20
+            print(
+                f"{len(points):>8} {len(points) * 3600 / elapsed:>10.0f}{stages} {written:>8.2f}MB"
+            )
+        finally:
+            shutil.rmtree(target)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from data_process import define_ranges, integrate_amplitude_divide_pi
+from scan_dataset import open_dataset
+from scan_file import SCAN_SUFFIX, create_scan
+
+
+def make_synthetic_scan(path: str, side: int, points: int) -> None:
+    rng = np.random.default_rng(0)
+    x = np.arange(side, dtype=np.float64)
+    freqs = np.linspace(30e6, 1e9, points)
+    with create_scan(path, x, x, freqs, {"units": "dBuV"}) as scan:
+        for i in range(side):
+            scan.data[i] = rng.normal(40, 3, (side, points)).astype(np.float32)
+        scan.mask[:] = 1
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="dataset slice benchmark",
+        description="Compare integrating the bands of a whole synthetic scan file with reading and integrating slices of it through ScanDataset.",
+    )
+    parser.add_argument(
+        "-n",
+        "--sizes",
+        type=int,
+        nargs="+",
+        help="Side of the square grid of points. Default is 50 100",
+        default=[50, 100],
+    )
+    parser.add_argument(
+        "--points",
+        type=int,
+        help="Frequency points of every spectrum. Default is 4801",
+        default=4801,
+    )
+    args = parser.parse_args()
+
+    # the scan was just written, so its pages are likely in the page cache and
+    # the times compare the work done rather than the disk
+    print(
+        f"{'points':>8} {'size':>9} {'whole [s]':>10} {'region [s]':>11} {'band [s]':>9} {'point [ms]':>11}"
+    )
+    for side in args.sizes:
+        target = tempfile.mkdtemp(prefix="emi-bench-")
+        try:
+            path = os.path.join(target, "scan" + SCAN_SUFFIX)
+            make_synthetic_scan(path, side, args.points)
+            dataset = open_dataset(path)
+            ranges = define_ranges(dataset, 50e6)
+            whole = timed(integrate_amplitude_divide_pi, dataset, ranges)
+            quarter = side / 4
+            region = dataset.region(x=(0, quarter), y=(0, quarter))
+            region_time = timed(integrate_amplitude_divide_pi, region, ranges)
+            band_time = timed(integrate_amplitude_divide_pi, dataset, [(140e6, 160e6)])
+            point_time = timed(dataset.point, side // 2, side // 2)
+            size = os.path.getsize(path) / 2**20
+            print(
+                f"{side * side:>8} {size:>7.0f}MB {whole:>10.3f} {region_time:>11.3f} {band_time:>9.3f} {point_time * 1000:>11.2f}"
+            )
+        finally:
+            shutil.rmtree(target)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from scan_file import list_point_files, point_file_name, read_csv_dir
+
+EXAMPLE = (
+    Path(__file__).resolve().parents[2]
+    / "examples"
+    / "measurement"
+    / "SDI-MIPI-Bridge_P2_RMS_dbuV"
+)
+
+
+# the loader data_process.py used before the bulk loader, kept as the reference
+def legacy_load_measurement(folder_path: str):
+    csv_files = [file for file in os.listdir(folder_path) if file.endswith(".csv")]
+    combined_df = pd.DataFrame()
+    for file in csv_files:
+        floor = file.find("_")
+        x_value = file[1:floor]
+        y_value = file[floor + 2 : -4]
+
+        df = pd.read_csv(os.path.join(folder_path, file))
+
+        df["x"] = float(x_value)
+        df["y"] = float(y_value)
+        combined_df = pd.concat([combined_df, df], ignore_index=True)
+    combined_df = combined_df.rename(columns={"# f[Hz]": "f", " a[dB]": "a"})
+    return combined_df
+
+
+def make_synthetic_scan(source: Path, target: str, count: int) -> None:
+    # tile the bundled measurement over a larger square grid with a 1 mm pitch
+    traces = [(source / p[2]).read_bytes() for p in sorted(list_point_files(source))]
+    side = math.ceil(math.sqrt(count))
+    for n in range(count):
+        name = point_file_name(float(n // side), float(n % side))
+        with open(os.path.join(target, name), "wb") as f:
+            f.write(traces[n % len(traces)])
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="load measurement benchmark",
+        description="Compare the legacy per-file pd.concat loader with the bulk CSV loader on synthetic scans built from the SDI-MIPI example.",
+    )
+    parser.add_argument(
+        "-n",
+        "--sizes",
+        type=int,
+        nargs="+",
+        help="Numbers of measurement files to benchmark. Default is 96 1000 4000 10000",
+        default=[96, 1000, 4000, 10000],
+    )
+    parser.add_argument(
+        "--legacy-limit",
+        type=int,
+        help="Skip the quadratic legacy loader above this many files, its time is extrapolated from the largest size it ran on. Default is 10000",
+        default=10000,
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help="Number of processes used by the bulk loader. Default is the number of CPUs",
+    )
+    args = parser.parse_args()
+
+    print(f"{'files':>8} {'legacy [s]':>12} {'bulk [s]':>10} {'speedup':>9}")
+    # the largest size the legacy loader ran on and its time
+    measured = None
+    for count in sorted(args.sizes):
+        target = tempfile.mkdtemp(prefix="emi-bench-")
+        try:
+            make_synthetic_scan(EXAMPLE, target, count)
+            bulk = timed(read_csv_dir, target, args.workers)
+            if count <= args.legacy_limit:
+                legacy = timed(legacy_load_measurement, target)
+                measured = (count, legacy)
+                print(
+                    f"{count:>8} {legacy:>12.2f} {bulk:>10.2f} {legacy / bulk:>8.1f}x"
+                )
+            elif measured is not None:
+                # every concatenation copies the rows so far, the time grows
+                # with the square of the number of files
+                legacy = measured[1] * (count / measured[0]) ** 2
+                print(
+                    f"{count:>8} {'~' + format(legacy, '.2f'):>12} {bulk:>10.2f} {legacy / bulk:>8.1f}x"
+                    f"  legacy skipped, extrapolated from {measured[0]} files"
+                )
+            else:
+                print(
+                    f"{count:>8} {'skipped':>12} {bulk:>10.2f} {'-':>9}  legacy skipped"
+                )
+        finally:
+            shutil.rmtree(target)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ import serial.tools.list_ports
 import logging
 import vector
 import re
+from collections import deque
+from typing import Optional
 
 
 logging.basicConfig()
@@ -10,57 +12,193 @@ logger = logging.getLogger("main")
 logger.setLevel(logging.DEBUG)
 
 
-def init_plotter(device: str) -> serial.Serial:
-    plotter = serial.Serial(device, baudrate=115200)
-    time.sleep(3)
-    plotter.read_all()
-    send_to_plotter(plotter, "M420 S0", wait=False)  # Disable autoleveld
-    send_to_plotter(plotter, "G21")
-    send_to_plotter(plotter, "G92 X0")
-    send_to_plotter(plotter, "G92 Y0")
-    send_to_plotter(plotter, "G92 Z0")
-    time.sleep(3)
-    return plotter
+# commands sent ahead of their acknowledgement, Marlin's default BUFSIZE
+DEFAULT_WINDOW = 4
+# round trips kept per command for the timing statistics
+TIMING_HISTORY = 1000
+# seconds without a line from the firmware before streaming starts
+QUIET_TIME = 1.0
+# Marlin answers M114 with "X:1.00 Y:2.00 Z:3.00 E:0.00 Count X:..."
+MARLIN_POSITION = re.compile(r"X:\s*(-?[0-9.]+)\s+Y:\s*(-?[0-9.]+)\s+Z:\s*(-?[0-9.]+)")
+
+
+class PlotterStream:
+    # Streams G-code to Marlin with ok-based flow control: up to window
+    # commands are sent ahead of their "ok", so the planner keeps moves queued,
+    # and each "ok" acknowledges the oldest command still pending. Only sync()
+    # waits for the moves to finish, through M400.
+    def __init__(
+        self,
+        port: serial.Serial,
+        window: int = DEFAULT_WINDOW,
+        timeout: float = 10,
+    ):
+        self.port = port
+        self.window = window
+        self.timeout = timeout
+        self.pending = deque()
+        self.timings = {}
+
+    def send(self, command: str) -> None:
+        while len(self.pending) >= self.window:
+            self.acknowledge()
+        logger.debug("Sending to plotter: %s", command)
+        self.port.write((command + "\r\n").encode("ASCII"))
+        self.pending.append((command, time.monotonic()))
+
+    def acknowledge(self, timeout: Optional[float] = None) -> list:
+        # lines answered to the oldest pending command, up to its "ok"
+        timeout = self.timeout if timeout is None else timeout
+        command, sent = self.pending[0]
+        self.port.timeout = timeout
+        lines = []
+        while True:
+            line = self.port.readline()
+            if not line:
+                logger.error("Plotter didn't acknowledge %s in %d s", command, timeout)
+                raise TimeoutError(f"Plotter didn't acknowledge {command}")
+            line = line.decode("ASCII", errors="replace").strip()
+            if line.startswith("ok"):
+                break
+            # Marlin follows errors and unknown commands with an "ok" as well
+            if line.lower().startswith("error") or "Unknown command" in line:
+                logger.warning("Plotter answered %s with %s", command, line)
+            # busy reports come while a long move blocks the planner
+            if not line.startswith("echo:busy"):
+                lines.append(line)
+        self.pending.popleft()
+        self.record(command, time.monotonic() - sent)
+        return lines
+
+    def record(self, command: str, elapsed: float) -> None:
+        code = command.split()[0].upper() if command.split() else command
+        self.timings.setdefault(code, deque(maxlen=TIMING_HISTORY)).append(elapsed)
+
+    def drain(self, timeout: Optional[float] = None) -> None:
+        while self.pending:
+            self.acknowledge(timeout)
+
+    def sync(self, timeout: Optional[float] = None) -> None:
+        # M400 is acknowledged only once every queued move has finished
+        self.send("M400")
+        self.drain(timeout)
+
+    def query(self, command: str, timeout: Optional[float] = None) -> list:
+        # a command whose answer is needed, sent once the stream is empty
+        self.drain(timeout)
+        self.send(command)
+        return self.acknowledge(timeout)
+
+    def timing_summary(self) -> str:
+        # round trips from sending a command to its "ok", per G-code
+        lines = []
+        for code, timings in sorted(self.timings.items()):
+            values = sorted(timings)
+            lines.append(
+                f"{code}: {len(values)} commands, median {values[len(values) // 2] * 1000:.1f} ms, max {values[-1] * 1000:.1f} ms"
+            )
+        return "\n".join(lines)
+
+
+def init_plotter(
+    device: str, position: Optional[vector.Vector3D] = None
+) -> PlotterStream:
+    return setup_plotter(serial.Serial(device, baudrate=115200), position)
+
+
+def setup_plotter(
+    plotter: serial.Serial,
+    position: Optional[vector.Vector3D] = None,
+    window: int = DEFAULT_WINDOW,
+) -> PlotterStream:
+    # takes any object with the serial port's interface, e.g. a simulated one
+    wait_for_firmware(plotter)
+    stream = PlotterStream(plotter, window)
+    stream.send("M420 S0")  # Disable autoleveld
+    stream.send("G21")
+    if position is None:
+        stream.send("G92 X0 Y0 Z0")
+    else:
+        # continue in the coordinates of an interrupted scan, the probe is
+        # assumed to still be where it was last sent
+        stream.send(f"G92 X{position.x:.2f} Y{position.y:.2f} Z{position.z:.2f}")
+    stream.drain()
+    return stream
+
+
+def read_until_quiet(plotter: serial.Serial, deadline: float) -> None:
+    # discards lines until none has come for QUIET_TIME
+    plotter.timeout = QUIET_TIME
+    while plotter.readline():
+        if time.monotonic() > deadline:
+            logger.error("Plotter didn't go quiet")
+            raise TimeoutError("Plotter didn't go quiet")
+
+
+def wait_for_firmware(plotter: serial.Serial, timeout: float = 10) -> float:
+    # opening the port resets most boards, the probe is sent once the boot
+    # messages are over. A single probe is sent, every probe gets its own "ok"
+    # and one arriving late would acknowledge a command of the stream.
+    start = time.monotonic()
+    deadline = start + timeout
+    read_until_quiet(plotter, deadline)
+    plotter.write("M400\r\n".encode("ASCII"))
+    while True:
+        plotter.timeout = max(deadline - time.monotonic(), 0)
+        line = plotter.readline()
+        if not line:
+            logger.error("Plotter didn't respond in %d s", timeout)
+            raise TimeoutError("Plotter didn't respond")
+        if line.strip().startswith(b"ok"):
+            break
+    # anything the firmware still had to say is dropped before streaming
+    read_until_quiet(plotter, deadline + timeout)
+    elapsed = time.monotonic() - start
+    logger.debug("Plotter ready after %.2f s", elapsed)
+    return elapsed
 
 
 def send_to_plotter(
-    plotter: serial.Serial, command: str, wait: bool = True, timeout=10
+    plotter: PlotterStream, command: str, wait: bool = True, timeout=10
 ) -> None:
-    plotter.read_all()
-    plotter.timeout = timeout
-    logger.debug("Sending to plotter: %s", command)
-    plotter.write((command + "\r\n").encode("ASCII"))
+    # queued behind the commands in flight, waits for the moves to finish
+    # only when asked to
+    plotter.send(command)
     if wait:
-        plotter.write("M400\r\n".encode("ASCII"))
-        p = plotter.readline()
-        plotter.readline()
-        plotter.readline()
-        logger.debug(f"{p}")
+        plotter.sync(timeout)
 
 
-def moveAbs_plotter_to(plotter: serial.Serial, position: vector.Vector3D) -> None:
+def moveAbs_plotter_to(
+    plotter: PlotterStream, position: vector.Vector3D, wait: bool = True
+) -> None:
     send_to_plotter(
-        plotter, f"G90 X{position.x:.2f} Y{position.y:.2f} Z{position.z:.2f}"
+        plotter, f"G90 X{position.x:.2f} Y{position.y:.2f} Z{position.z:.2f}", wait
     )
 
 
-def moveRel_plotter_to(plotter: serial.Serial, position: vector.Vector3D) -> None:
+def moveRel_plotter_to(
+    plotter: PlotterStream, position: vector.Vector3D, wait: bool = True
+) -> None:
     send_to_plotter(
-        plotter, f"G91 X{position.x:.2f} Y{position.y:.2f} Z{position.z:.2f}"
+        plotter, f"G91 X{position.x:.2f} Y{position.y:.2f} Z{position.z:.2f}", wait
     )
 
 
-def get_plotter_position(plotter: serial.Serial) -> vector.Vector3D:
-    send_to_plotter(plotter, "?", wait=False)
-    ret = plotter.readline()
-    ret = ret.decode("ASCII")
-    ret = ret[10:]
-
-    def get_coordinate(ret):
-        match = re.findall(f"(-?[0-9]+.[0-9]+)", ret)
+def parse_position(lines: list) -> Optional[tuple]:
+    # the first position report among the lines
+    for line in lines:
+        match = MARLIN_POSITION.search(line)
         if match is not None:
-            return float(match[0]), float(match[1]), float(match[2])
+            return tuple(float(value) for value in match.groups())
+    return None
+
 
-    x, y, z = get_coordinate(ret)
+def get_plotter_position(plotter: PlotterStream) -> vector.Vector3D:
+    lines = plotter.query("M114")
+    position = parse_position(lines)
+    if position is None:
+        logger.error("Plotter didn't report its position: %s", lines)
+        raise ValueError("Plotter didn't report its position")
+    x, y, z = position
     logger.info(f"Printer pos \n x:{x}, y:{y}, z:{z}")
     return vector.obj(x=x, y=y, z=z)
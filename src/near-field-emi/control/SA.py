@@ -1,9 +1,13 @@
-from typing import Literal, Tuple
+from typing import Callable, Literal, Optional, Tuple
 import vxi11
 import logging
 import numpy as np
+from collections import deque
+from contextlib import contextmanager
 from pathlib import Path
+import re
 import sys
+import time
 
 
 logging.basicConfig()
@@ -11,23 +15,325 @@ logger = logging.getLogger("main")
 logger.setLevel(logging.DEBUG)
 
 
-def init_instrument(address: str) -> vxi11.Instrument:
-    instr = vxi11.Instrument(address)
-    instr.write("FORMAT REAL,32")
-    return instr
+# a header and its argument in one of the commands of a compound message
+SCPI_COMMAND = re.compile(r"^\s*(\*?[:A-Za-z0-9\[\]]+\??)\s*(.*?)\s*$")
+# failures of the VXI-11 link after which the session reconnects
+LINK_ERRORS = (vxi11.vxi11.Vxi11Exception, OSError)
+RECONNECT_ATTEMPTS = 4
+RECONNECT_BACKOFF = 0.5
+# latencies kept per query for the statistics
+LATENCY_HISTORY = 1000
+# settings the SA may change by itself when one starting with the key is
+# written, like the auto RBW and sweep time following the span
+COUPLED_SETTINGS = {
+    ":FREQ:": (":FREQ:", ":BAND", ":SWE:TIME"),
+    ":BAND": (":BAND", ":SWE:TIME"),
+    ":DET:FUNC": (":BAND", ":SWE:TIME"),
+}
+
+
+def split_commands(message: str) -> list:
+    # (header, argument) of every command of a compound message, headers
+    # relative to the previous one's subsystem are made absolute
+    commands = []
+    root = ""
+    for part in message.split(";"):
+        match = SCPI_COMMAND.match(part)
+        if match is None or not match.group(1):
+            continue
+        header, argument = match.groups()
+        if header.startswith("*"):
+            commands.append((header, argument))
+            continue
+        if not header.startswith(":"):
+            header = root + header
+        nodes = header.lstrip(":").split(":")
+        root = ":".join(nodes[:-1]) + ":" if len(nodes) > 1 else ""
+        commands.append((":" + header.lstrip(":"), argument))
+    return commands
+
+
+def short_node(node: str) -> str:
+    # the upper case part of a node spelled as in the manuals, otherwise the
+    # SCPI rule: four letters, three if the fourth is a vowel
+    name = node.strip("[]").rstrip("0123456789?")
+    suffix = node.strip("[]")[len(name) :]
+    if name not in (name.upper(), name.lower()):
+        return "".join(c for c in name if c.isupper()) + suffix
+    name = name.upper()
+    if len(name) > 4:
+        name = name[:3] if name[3] in "AEIOU" else name[:4]
+    return name + suffix
+
+
+def setting_key(header: str) -> str:
+    # any spelling of a header gives the same key, the optional SENSe root
+    # is left out
+    if header.startswith("*"):
+        return header.upper()
+    nodes = [short_node(node) for node in header.lstrip(":").split(":") if node]
+    if len(nodes) > 1 and nodes[0] == "SENS":
+        nodes = nodes[1:]
+    return ":" + ":".join(nodes)
+
+
+def join_commands(commands: list) -> str:
+    return ";".join(f"{header} {argument}".strip() for header, argument in commands)
+
+
+class SASession:
+    # Wraps the VXI-11 instrument with the same interface, so every function
+    # below takes either. Settings written are remembered by the short form of
+    # their header and writing a value the instrument already has is skipped,
+    # settings coupled to a written one are forgotten. Inside batch() the
+    # settings are sent as one compound message followed by a single SYST:ERR?
+    # check, a query inside sends the settings queued before it first. When
+    # the link times out the session reconnects with backoff, restores the
+    # remembered settings and retries the message.
+    def __init__(
+        self,
+        instr: vxi11.Instrument,
+        connect: Optional[Callable[[], vxi11.Instrument]] = None,
+    ):
+        self.instr = instr
+        self.connect = connect
+        self.settings = {}
+        self.queued = None
+        self.latencies = {}
+
+    @property
+    def timeout(self) -> float:
+        return self.instr.timeout
+
+    @timeout.setter
+    def timeout(self, value: float) -> None:
+        self.instr.timeout = value
+
+    def _call(self, method: str, message):
+        for attempt in range(RECONNECT_ATTEMPTS + 1):
+            try:
+                if attempt:
+                    self.reconnect()
+                return getattr(self.instr, method)(message)
+            except LINK_ERRORS as error:
+                if self.connect is None or attempt == RECONNECT_ATTEMPTS:
+                    # whatever was written may not have reached the instrument
+                    self.settings.clear()
+                    raise
+                delay = RECONNECT_BACKOFF * 2**attempt
+                logger.warning(
+                    "SA link failed (%s), reconnecting in %.1f s", error, delay
+                )
+                time.sleep(delay)
+
+    def reconnect(self) -> None:
+        timeout = self.instr.timeout
+        try:
+            self.instr.close()
+        except LINK_ERRORS:
+            pass
+        self.instr = self.connect()
+        self.instr.timeout = timeout
+        if self.settings:
+            self.instr.write(join_commands(self.settings.values()))
+
+    def write(self, message: str) -> None:
+        commands = []
+        written = set()
+        for header, argument in split_commands(message):
+            key = setting_key(header)
+            if key == "*RST":
+                self.settings.clear()
+            elif argument and not header.endswith("?"):
+                known = self.settings.get(key)
+                if known is not None and known[1] == argument:
+                    continue
+                # settings sent together, like STARt and STOP, are kept
+                self.forget_coupled(key, written)
+                self.settings[key] = (header, argument)
+                written.add(key)
+            commands.append((header, argument))
+        if not commands:
+            return
+        if self.queued is not None:
+            self.queued.extend(commands)
+            return
+        self._call("write", join_commands(commands))
+
+    def forget_coupled(self, key: str, keep: set = frozenset()) -> None:
+        for prefix, coupled in COUPLED_SETTINGS.items():
+            if key.startswith(prefix):
+                for known in list(self.settings):
+                    if known.startswith(coupled) and known not in keep:
+                        del self.settings[known]
+
+    def _flush(self) -> None:
+        # sends the settings queued by batch() and checks them
+        commands, self.queued = self.queued, []
+        if commands:
+            self._call("write", join_commands(commands))
+            self.check_errors()
+
+    def _query(self, method: str, message):
+        header = split_commands(
+            message.decode("ASCII") if isinstance(message, bytes) else message
+        )[0][0]
+        # a query answers with the settings written before it
+        if self.queued:
+            self._flush()
+        start = time.monotonic()
+        response = self._call(method, message)
+        latencies = self.latencies.setdefault(
+            setting_key(header), deque(maxlen=LATENCY_HISTORY)
+        )
+        latencies.append(time.monotonic() - start)
+        return response
+
+    def ask(self, message: str) -> str:
+        return self._query("ask", message)
+
+    def ask_raw(self, message: bytes) -> bytes:
+        return self._query("ask_raw", message)
+
+    def check_errors(self) -> None:
+        # the error queue is read until it's empty, the first query costs the
+        # only round trip when nothing went wrong
+        errors = []
+        while len(errors) < 32:
+            error = self._call("ask", ":SYSTem:ERRor?").strip()
+            if int(error.split(",")[0]) == 0:
+                break
+            errors.append(error)
+        if errors:
+            # the instrument's state is unknown after a rejected setting
+            self.settings.clear()
+            logger.error("SA reported errors: %s", "; ".join(errors))
+            raise RuntimeError(f"SA reported errors: {'; '.join(errors)}")
+
+    @contextmanager
+    def batch(self):
+        # settings written inside are sent together once the block ends
+        if self.queued is not None:
+            yield self
+            return
+        self.queued = []
+        try:
+            yield self
+            self._flush()
+        except BaseException:
+            # the settings queued were remembered but may never have been sent
+            self.settings.clear()
+            raise
+        finally:
+            self.queued = None
+
+    def latency_stats(self) -> dict:
+        # count, mean, median, 95th percentile and max of every query, in s
+        stats = {}
+        for header, latencies in self.latencies.items():
+            values = np.array(latencies)
+            stats[header] = {
+                "count": len(values),
+                "mean": float(values.mean()),
+                "median": float(np.median(values)),
+                "p95": float(np.percentile(values, 95)),
+                "max": float(values.max()),
+            }
+        return stats
+
+    def latency_summary(self) -> str:
+        return "\n".join(
+            f"{header}: {stat['count']} queries, median {stat['median'] * 1000:.1f} ms, p95 {stat['p95'] * 1000:.1f} ms, max {stat['max'] * 1000:.1f} ms"
+            for header, stat in sorted(self.latency_stats().items())
+        )
+
+    def close(self) -> None:
+        self.instr.close()
+
+
+def init_instrument(address: str) -> SASession:
+    return setup_instrument(
+        vxi11.Instrument(address), lambda: vxi11.Instrument(address)
+    )
+
+
+def setup_instrument(
+    instr: vxi11.Instrument,
+    connect: Optional[Callable[[], vxi11.Instrument]] = None,
+) -> SASession:
+    # takes any object with the VXI-11 instrument's interface, connect opens
+    # a new link to the same instrument when the current one fails
+    session = SASession(instr, connect)
+    session.write("*CLS")
+    with session.batch():
+        session.write("FORMAT REAL,32")
+    return session
 
 
 def query_spectrum(
     instr: vxi11.Instrument,
 ) -> np.ndarray[Literal["N"], np.dtype[np.float32]]:
-    data = instr.ask_raw("TRACe:DATA? TRACE1".encode("ASCII"))
-    if data[0] != b"#"[0]:
+    return parse_spectrum(read_spectrum_block(instr))
+
+
+def read_spectrum_block(instr: vxi11.Instrument, trace: int = 1) -> bytes:
+    return instr.ask_raw(f"TRACe:DATA? TRACE{trace}".encode("ASCII"))
+
+
+def parse_spectrum(data: bytes) -> np.ndarray[Literal["N"], np.dtype[np.float32]]:
+    # IEEE 488.2 definite length block: '#', the number of digits of the
+    # length, the length in bytes and the payload, read in place
+    block = memoryview(data)
+    if len(block) < 2 or block[0] != ord("#"):
         logger.error("Response from SA didn't begin with '#'")
         sys.exit()
-    len_of_count = int(data[1:2].decode("ASCII"))
-    count = int(data[2 : 2 + len_of_count])
+    len_of_count = int(chr(block[1]))
+    offset = 2 + len_of_count
+    if len_of_count == 0:
+        # indefinite length, the payload runs up to the terminating newline
+        count = len(block) - offset - (block[-1] == ord("\n"))
+    else:
+        count = int(block[2:offset].tobytes())
+    if len(block) < offset + count:
+        logger.error("Block from SA holds %d of %d bytes", len(block) - offset, count)
+        sys.exit()
     logger.debug("Received data from SA. Count: %d", count)
-    return np.frombuffer(data[2 + len_of_count : -1], dtype=np.dtype(np.float32))
+    return np.frombuffer(
+        block, dtype=np.dtype(np.float32), count=count // 4, offset=offset
+    )
+
+
+def set_single_sweep(instr: vxi11.Instrument):
+    instr.write(":INITiate:CONTinuous OFF")
+
+
+def set_continuous_sweep(instr: vxi11.Instrument):
+    instr.write(":INITiate:CONTinuous ON")
+
+
+def query_sweep_time(instr: vxi11.Instrument) -> float:
+    sweep_time = float(instr.ask(":SENSe:SWEep:TIME?"))
+    logger.debug("Received sweep time from SA: %f", sweep_time)
+    return sweep_time
+
+
+def trigger_sweep(instr: vxi11.Instrument, sweep_time: float) -> float:
+    # *OPC? is answered only after the triggered sweep has completed, so the
+    # trace read afterwards was captured entirely at the current position
+    start = time.monotonic()
+    timeout = instr.timeout
+    instr.timeout = max(timeout, 2 * sweep_time + 5)
+    try:
+        instr.ask(":INITiate:IMMediate;*OPC?")
+    finally:
+        instr.timeout = timeout
+    return time.monotonic() - start
+
+
+def query_sweep_points(instr: vxi11.Instrument) -> int:
+    points = int(float(instr.ask(":SENSe:SWEep:POINts?")))
+    logger.debug("Received sweep points from SA: %d", points)
+    return points
 
 
 def query_frequency_span(
@@ -44,7 +350,13 @@ def set_frequency_span(instr: vxi11.Instrument, start: float, stop: float):
 
 
 def set_RBW(instr: vxi11.Instrument, value: float):
-    instr.write({f"[:SENSe]:BANDwidth[:RESolution] {value}"})
+    instr.write(f":SENSe:BANDwidth:RESolution {value}")
+
+
+def query_RBW(instr: vxi11.Instrument) -> float:
+    rbw = float(instr.ask(":SENSe:BANDwidth:RESolution?"))
+    logger.debug("Received RBW from SA: %f", rbw)
+    return rbw
 
 
 def calculate_frequencies(
@@ -65,6 +377,15 @@ def setQPeakDet(instr: vxi11.Instrument):
     instr.write(f":SENSe:DETector:FUNCtion QPEak")
 
 
+DETECTOR_NAMES = {"POS": "POSitive", "RMS": "RMS", "QUASI": "QPEak"}
+
+
+def set_detector(instr: vxi11.Instrument, detector: str):
+    # the DSA815 has a single detector for all of its traces, so every
+    # detector takes a sweep of its own
+    instr.write(f":SENSe:DETector:FUNCtion {DETECTOR_NAMES[detector]}")
+
+
 def getDet(instr: vxi11.Instrument):
     det = str(instr.ask(":SENSe:DETector:FUNCtion?"))
     logger.info(f"Detector: {det}")
@@ -92,16 +413,20 @@ def setY_W(instr: vxi11.Instrument):
 
 
 def save_data(
-    data: np.ndarray[Literal["N"], np.dtype[np.float32]],
+    data: np.ndarray,
     start: float,
     stop: float,
     path: Path,
+    traces: Optional[list] = None,
 ) -> None:
-    freqs = calculate_frequencies(start, stop, len(data))
-    data_with_freqs = np.stack((freqs, data), axis=1)
+    # data holds a row per trace when several traces are named
+    rows = np.atleast_2d(data)
+    freqs = calculate_frequencies(start, stop, rows.shape[1])
+    data_with_freqs = np.column_stack((freqs, *rows))
+    header = "f[Hz], a[dB]"
+    if traces and len(traces) > 1:
+        header = "f[Hz], " + ", ".join(f"{name}[dB]" for name in traces)
     if path.parent.exists():
-        np.savetxt(
-            path, data_with_freqs, delimiter=",", newline="\n", header="f[Hz], a[dB]"
-        )
+        np.savetxt(path, data_with_freqs, delimiter=",", newline="\n", header=header)
     else:
         logger.error("Directory %s doesn't exist", path.parent)
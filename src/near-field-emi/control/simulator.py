@@ -0,0 +1,379 @@
+import json
+import logging
+import math
+import re
+import time
+from collections import deque
+from typing import Optional
+
+import numpy as np
+
+logging.basicConfig()
+logger = logging.getLogger("main")
+logger.setLevel(logging.DEBUG)
+
+# Stand-ins for the serial port of the plotter and the VXI-11 connection of
+# the spectrum analyser, so the acquisition can be run and profiled without a
+# bench. Both share a SimulatedBench, through which the SA sees the field at
+# the probe's current position. The bench keeps its own clock, advanced by every
+# simulated delay, and really sleeps for the delay multiplied by the time
+# scale, which allows running simulated scans faster than real time.
+
+
+class SimulatedBench:
+    def __init__(
+        self,
+        field: Optional["FieldModel"] = None,
+        time_scale: float = 1.0,
+        feedrate: float = 3000.0,
+    ):
+        self.field = field or FieldModel()
+        self.time_scale = time_scale
+        self.clock = 0.0
+        self.plotter = SimulatedPlotter(self, feedrate)
+        self.instrument = SimulatedInstrument(self)
+
+    def sleep(self, seconds: float) -> None:
+        if seconds <= 0:
+            return
+        self.clock += seconds
+        if self.time_scale > 0:
+            time.sleep(seconds * self.time_scale)
+
+    def now(self) -> float:
+        return self.clock
+
+
+class FieldModel:
+    # Emissions are a set of hotspots, each radiating a comb of harmonics of a
+    # fundamental frequency and decaying with the distance from its position.
+    # A hotspot with a duty below 1 emits in that fraction of the sweeps.
+    def __init__(
+        self,
+        hotspots: Optional[list] = None,
+        noise_floor: float = 35.0,
+        noise: float = 0.5,
+        seed: int = 0,
+    ):
+        self.hotspots = (
+            hotspots
+            if hotspots is not None
+            else [
+                {"x": 20.0, "y": 15.0, "radius": 8.0, "level": 25.0, "f0": 148.5e6},
+                {"x": 50.0, "y": 25.0, "radius": 5.0, "level": 15.0, "f0": 100e6},
+            ]
+        )
+        self.noise_floor = noise_floor
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+    @classmethod
+    def load(cls, path: str) -> "FieldModel":
+        with open(path, encoding="utf-8") as f:
+            return cls(**json.load(f))
+
+    def spectrum(
+        self, x_pos: float, y_pos: float, freqs: np.ndarray, rbw: float
+    ) -> np.ndarray:
+        # powers are added linearly and returned in dBuV, lines are at least
+        # one bin wide so they don't fall between the trace points
+        width = max(rbw, (freqs[-1] - freqs[0]) / max(len(freqs) - 1, 1))
+        power = np.full(len(freqs), 10 ** (self.noise_floor / 10))
+        for spot in self.hotspots:
+            # an intermittent emitter is only on during some of the sweeps
+            if self.rng.random() >= spot.get("duty", 1.0):
+                continue
+            distance2 = (x_pos - spot["x"]) ** 2 + (y_pos - spot["y"]) ** 2
+            gain = math.exp(-distance2 / (2 * spot["radius"] ** 2))
+            harmonics = np.arange(spot["f0"], freqs[-1] + width, spot["f0"])
+            for harmonic in harmonics:
+                line = np.exp(-(((freqs - harmonic) / width) ** 2))
+                power += 10 ** ((self.noise_floor + spot["level"]) / 10) * gain * line
+        levels = 10 * np.log10(power)
+        return (levels + self.rng.normal(0, self.noise, len(freqs))).astype(np.float32)
+
+
+class SimulatedPlotter:
+    # Interprets the G-code sent by control/CNC.py. Moves are queued like in
+    # the firmware planner: they're acknowledged immediately, while M400 is
+    # acknowledged only once the last queued move has finished.
+    def __init__(
+        self,
+        bench: SimulatedBench,
+        feedrate: float = 3000.0,
+        acceleration: float = 500.0,
+    ):
+        self.bench = bench
+        self.feedrate = feedrate
+        self.acceleration = acceleration
+        self.timeout = None
+        self.position = [0.0, 0.0, 0.0]
+        self.relative = False
+        self.busy_until = 0.0
+        self.output = deque()
+        self.buffer = b""
+        self.commands = 0
+
+    def move_time(self, distance: float) -> float:
+        # trapezoidal velocity profile, in simulated seconds
+        speed = self.feedrate / 60.0
+        ramp = speed**2 / self.acceleration
+        if distance >= ramp:
+            return 2 * speed / self.acceleration + (distance - ramp) / speed
+        return 2 * math.sqrt(distance / self.acceleration)
+
+    def _respond(self, line: str, at: Optional[float] = None) -> None:
+        self.output.append(
+            (self.bench.now() if at is None else at, line.encode("ASCII"))
+        )
+
+    def _execute(self, command: str) -> None:
+        self.commands += 1
+        words = dict(
+            (word[0], word[1:])
+            for word in command.upper().split()
+            if word and word[0].isalpha()
+        )
+        code = command.split()[0].upper() if command.split() else ""
+        if code in ("G0", "G1") or (
+            code in ("G90", "G91") and any(a in words for a in "XYZ")
+        ):
+            if code == "G90":
+                self.relative = False
+            elif code == "G91":
+                self.relative = True
+            if "F" in words:
+                self.feedrate = float(words["F"])
+            target = list(self.position)
+            for axis, name in enumerate("XYZ"):
+                if name in words:
+                    value = float(words[name])
+                    target[axis] = target[axis] + value if self.relative else value
+            distance = math.dist(self.position, target)
+            self.busy_until = max(self.busy_until, self.bench.now()) + self.move_time(
+                distance
+            )
+            self.position = target
+        elif code == "G90":
+            self.relative = False
+        elif code == "G91":
+            self.relative = True
+        elif code == "G92":
+            for axis, name in enumerate("XYZ"):
+                if name in words:
+                    self.position[axis] = float(words[name])
+        elif code == "M114":
+            x, y, z = self.position
+            self._respond(f"X:{x:.2f} Y:{y:.2f} Z:{z:.2f} E:0.00 Count X:0 Y:0 Z:0")
+        elif code == "M400":
+            self._respond("ok", max(self.busy_until, self.bench.now()))
+            return
+        elif code not in ("G21", "M420", "M110", "M115"):
+            logger.warning("Simulated plotter doesn't know the command %s", command)
+            self._respond(f'echo:Unknown command: "{command}"')
+        self._respond("ok")
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        while b"\n" in self.buffer:
+            line, self.buffer = self.buffer.split(b"\n", 1)
+            command = line.decode("ASCII").strip()
+            if command:
+                self._execute(command)
+        return len(data)
+
+    def readline(self) -> bytes:
+        # honours the port timeout like pyserial, returning b"" when it expires
+        if not self.output:
+            self.bench.sleep(self.timeout or 0)
+            return b""
+        ready, line = self.output[0]
+        wait = ready - self.bench.now()
+        if self.timeout is not None and wait > self.timeout:
+            self.bench.sleep(self.timeout)
+            return b""
+        self.bench.sleep(wait)
+        self.output.popleft()
+        return line + b"\n"
+
+    def close(self) -> None:
+        pass
+
+
+SCPI_HEADER = re.compile(r"^\s*(\*?[:A-Za-z0-9\[\]]+\??)\s*(.*?)\s*$")
+# a peak detector reads noise higher than an averaging one, while all of them
+# read the same level of a continuous emission line
+DETECTOR_OFFSETS = {"POSitive": 0.0, "QPEak": -2.5, "RMS": -5.0}
+
+
+def detector_name(argument: str) -> str:
+    for name in DETECTOR_OFFSETS:
+        if scpi_match(argument, name):
+            return name
+    raise ValueError(f"Unknown detector {argument}")
+
+
+def scpi_match(header: str, pattern: str) -> bool:
+    # every node may be sent in its short (upper case part) or long form and
+    # the optional [:SENSe] root may be left out
+    nodes = [n for n in header.upper().lstrip(":").split(":") if n]
+    patterns = [p for p in pattern.lstrip(":").split(":") if p]
+    if patterns[0] == "SENSe" and len(nodes) < len(patterns):
+        patterns = patterns[1:]
+    if len(nodes) != len(patterns):
+        return False
+    for node, node_pattern in zip(nodes, patterns):
+        short = "".join(c for c in node_pattern if not c.islower())
+        if node.rstrip("?") not in (short, node_pattern.upper()):
+            return False
+    return True
+
+
+class SimulatedInstrument:
+    # Understands the SCPI subset used by control/SA.py, including compound
+    # commands separated with ';' and the error queue.
+    def __init__(
+        self,
+        bench: SimulatedBench,
+        points: int = 601,
+        sweep_coefficient: float = 2.5,
+        min_sweep_time: float = 0.01,
+        latency: float = 0.005,
+        model: str = "DSA815",
+    ):
+        self.bench = bench
+        self.model = model
+        self.points = points
+        self.sweep_coefficient = sweep_coefficient
+        self.min_sweep_time = min_sweep_time
+        self.latency = latency
+        self.timeout = 10
+        self.state = {
+            "start": 0.0,
+            "stop": 1.5e9,
+            "rbw": 1e6,
+            "unit": "DBM",
+            "detector": "POSitive",
+            "continuous": True,
+        }
+        self.errors = deque()
+        self.trace = None
+        self.queries = 0
+
+    def sweep_time(self) -> float:
+        # the usual k * span / RBW^2 estimate of swept analysers
+        span = self.state["stop"] - self.state["start"]
+        return max(
+            self.min_sweep_time, self.sweep_coefficient * span / self.state["rbw"] ** 2
+        )
+
+    def freqs(self) -> np.ndarray:
+        return np.linspace(self.state["start"], self.state["stop"], self.points)
+
+    def _sweep(self) -> None:
+        self.bench.sleep(self.sweep_time())
+        x_pos, y_pos, _ = self.bench.plotter.position
+        self.trace = self.bench.field.spectrum(
+            x_pos, y_pos, self.freqs(), self.state["rbw"]
+        )
+
+    def _trace_data(self) -> np.ndarray:
+        # the detectors only differ where the noise makes up the measured power
+        detector = self.state["detector"]
+        noise = 10 ** ((self.bench.field.noise_floor - self.trace) / 10)
+        offset = DETECTOR_OFFSETS[detector] * np.minimum(noise, 1)
+        return (self.trace + offset).astype(np.float32)
+
+    def _execute(self, header: str, argument: str) -> Optional[str]:
+        s = self.state
+        query = header.endswith("?")
+        if scpi_match(header, "FORMat") or scpi_match(header, "FORMat:DATA"):
+            return None
+        if scpi_match(header, "SENSe:FREQuency:STARt"):
+            return f"{s['start']:.6e}" if query else s.update(start=float(argument))
+        if scpi_match(header, "SENSe:FREQuency:STOP"):
+            return f"{s['stop']:.6e}" if query else s.update(stop=float(argument))
+        if scpi_match(header, "SENSe:BANDwidth:RESolution") or scpi_match(
+            header, "SENSe:BANDwidth"
+        ):
+            return f"{s['rbw']:.6e}" if query else s.update(rbw=float(argument))
+        if scpi_match(header, "SENSe:SWEep:POINts"):
+            return str(self.points) if query else setattr(self, "points", int(argument))
+        if scpi_match(header, "SENSe:SWEep:TIME"):
+            return f"{self.sweep_time():.6e}" if query else None
+        if scpi_match(header, "SENSe:DETector:FUNCtion") or scpi_match(
+            header, "SENSe:DETector"
+        ):
+            if query:
+                return s["detector"]
+            return s.update(detector=detector_name(argument))
+        if scpi_match(header, "UNIT:POWer"):
+            return s["unit"] if query else s.update(unit=argument.upper())
+        if scpi_match(header, "INITiate:CONTinuous"):
+            if query:
+                return "1" if s["continuous"] else "0"
+            return s.update(continuous=argument.upper() in ("ON", "1"))
+        if scpi_match(header, "INITiate:IMMediate") or scpi_match(header, "INITiate"):
+            return self._sweep()
+        if header == "*OPC?":
+            return "1"
+        if header in ("*WAI", "*CLS", "*OPC"):
+            return None
+        if header == "*IDN?":
+            return f"Rigol Technologies,{self.model},SIMULATED,00.01.19"
+        if scpi_match(header, "SYSTem:ERRor") or scpi_match(
+            header, "SYSTem:ERRor:NEXT"
+        ):
+            return self.errors.popleft() if self.errors else '0,"No error"'
+        if scpi_match(header, "TRACe:DATA"):
+            if self.trace is None or s["continuous"]:
+                self._sweep()
+            return self._trace_data()
+        logger.warning("Simulated SA doesn't know the header %s", header)
+        self.errors.append('-113,"Undefined header"')
+        return None
+
+    def _run(self, message: str) -> list:
+        # every message costs a network round trip
+        self.queries += 1
+        self.bench.sleep(self.latency)
+        responses = []
+        root = ""
+        for part in message.strip().split(";"):
+            match = SCPI_HEADER.match(part)
+            if match is None or not match.group(1):
+                continue
+            header, argument = match.groups()
+            # a relative header continues in the subsystem of the previous one
+            if not header.startswith((":", "*")) and root:
+                header = root + header
+            elif not header.startswith("*"):
+                nodes = header.lstrip(":").split(":")
+                root = ":".join(nodes[:-1]) + ":" if len(nodes) > 1 else ""
+            try:
+                response = self._execute(header, argument)
+            except ValueError:
+                self.errors.append('-224,"Illegal parameter value"')
+                continue
+            if response is not None:
+                responses.append(response)
+        return responses
+
+    def write(self, message: str) -> None:
+        self._run(message)
+
+    def ask(self, message: str) -> str:
+        responses = self._run(message)
+        return ";".join(r for r in responses if isinstance(r, str))
+
+    def ask_raw(self, message: bytes) -> bytes:
+        responses = self._run(message.decode("ASCII"))
+        for response in responses:
+            if isinstance(response, np.ndarray):
+                payload = response.astype("<f4").tobytes()
+                length = str(len(payload))
+                return f"#{len(length)}{length}".encode("ASCII") + payload + b"\n"
+        return ";".join(responses).encode("ASCII") + b"\n"
+
+    def close(self) -> None:
+        pass
@@ -3,27 +3,62 @@ import os
 import argparse
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.interpolate import RectBivariateSpline
-from scipy import integrate
+from scipy.interpolate import (
+    CloughTocher2DInterpolator,
+    NearestNDInterpolator,
+    make_interp_spline,
+)
+from scipy.spatial import Delaunay
 import sys
 import math
-
-
-def load_measurement(folder_path: str):
-    csv_files = [file for file in os.listdir(folder_path) if file.endswith(".csv")]
-    combined_df = pd.DataFrame()
-    for file in csv_files:
-        floor = file.find("_")
-        x_value = file[1:floor]
-        y_value = file[floor + 2 : -4]
-
-        df = pd.read_csv(os.path.join(folder_path, file))
-
-        df["x"] = float(x_value)
-        df["y"] = float(y_value)
-        combined_df = pd.concat([combined_df, df], ignore_index=True)
-    combined_df = combined_df.rename(columns={"# f[Hz]": "f", " a[dB]": "a"})
-    return combined_df
+import hashlib
+from typing import Optional
+from heatmap_image import (
+    COLOR_MAP,
+    heightmap_writers,
+    write_heatmaps,
+    write_heightmap_metadata,
+)
+from scan_dataset import COORDINATE_TOLERANCE, ScanDataset, as_dataset, load_scan
+from scan_file import Scan, is_scan_file, source_fingerprint
+from stage_cache import (
+    DEFAULT_CACHE_DIR,
+    DEFAULT_CACHE_SIZE,
+    StageCache,
+    cached_array,
+    cached_bands,
+    cached_scan,
+    stage_key,
+)
+
+# irregular point sets live on a fine lattice, cap their interpolated size
+MAX_SCATTERED_SIZE = 2400
+# degree of the splines interpolating regular grids
+SPLINE_DEGREE = 3
+# heatmap pixel size in mm
+DEFAULT_PIXEL_SIZE = 0.05
+# bands are interpolated in batches whose results take at most this many bytes
+INTERPOLATION_MEMORY = 1 << 28
+# pixels along the longer side of a band in the overview figure
+OVERVIEW_SIZE = 400
+
+
+def load_measurement(folder_path: str, workers: Optional[int] = None):
+    return scan_to_dataframe(load_scan(folder_path, workers))
+
+
+def scan_to_dataframe(scan: Scan):
+    # only the points which were actually captured end up in the frame
+    xi, yi = np.nonzero(scan.mask)
+    count = len(scan.freqs)
+    return pd.DataFrame(
+        {
+            "f": np.tile(scan.freqs, len(xi)),
+            "a": scan.data[xi, yi].reshape(-1).astype(np.float64),
+            "x": np.repeat(scan.x[xi], count),
+            "y": np.repeat(scan.y[yi], count),
+        }
+    )
 
 
 def define_unit(number: float):
@@ -37,18 +72,18 @@ def define_unit(number: float):
         return f"{number:.1f} Hz"
 
 
-def define_ranges(range_list: list, step: float):
-    start, end = range_list
-    end1 = end
+def define_ranges(range_list, step: float):
+    # bands between the multiples of the step within the span of a dataset or
+    # a [start, end] pair, a partial first band is merged into the next one
+    if isinstance(range_list, ScanDataset):
+        range_list = [range_list.freqs[0], range_list.freqs[-1]]
+    start, end = (float(edge) for edge in range_list)
+    first = math.floor(start / step) + 1
+    edges = [k * step for k in range(first, math.ceil(end / step))]
     if start % step != 0:
-        end1 = math.ceil(start / step) * step * 2
-    ranges = [(start, end1)]
-    num_ranges = (end - end1) // step
-    for i in range(math.floor(num_ranges)):
-        ranges.append((end1 + i * step, end1 + (i + 1) * step))
-    if end1 + num_ranges * step < end:
-        ranges.append((end1 + num_ranges * step, end))
-    return ranges
+        edges = edges[1:]
+    edges = [start] + edges + [end]
+    return list(zip(edges[:-1], edges[1:]))
 
 
 def define_plot_titles(ranges: list):
@@ -61,169 +96,316 @@ def define_plot_titles(ranges: list):
     return titles
 
 
-def get_meas_coords(meas_df: pd.DataFrame):
-    x = np.array(sorted(meas_df["x"].unique()))
-    y = np.array(sorted(meas_df["y"].unique()))
-    return x, y
+def get_meas_coords(measurement):
+    # axes of the captured points of a dataset or scan, or of a legacy frame
+    if isinstance(measurement, pd.DataFrame):
+        x = np.array(sorted(measurement["x"].unique()))
+        y = np.array(sorted(measurement["y"].unique()))
+        return x, y
+    return as_dataset(measurement).captured_axes()
 
 
-def round_one_digit(num: float):
-    return round(num, 1)
+def interpolate_frequencies(data: np.ndarray, freqs: np.ndarray, new_freqs: np.ndarray):
+    # linear interpolation along the last axis, shared by every point of the cube
+    upper = np.clip(np.searchsorted(freqs, new_freqs, side="right"), 1, len(freqs) - 1)
+    lower = upper - 1
+    weight = (new_freqs - freqs[lower]) / (freqs[upper] - freqs[lower])
+    weight = np.clip(weight, 0.0, 1.0).astype(np.float32)
+    return data[..., lower] * (1 - weight) + data[..., upper] * weight
 
 
-def remove_background(backmeas: pd.DataFrame, mainmeas: pd.DataFrame):
-    backmeas["f"] = backmeas["f"].apply(round_one_digit)
-    mainmeas["f"] = mainmeas["f"].apply(round_one_digit)
-    mainmeas["a"] = mainmeas["a"] - backmeas["a"]
-    return mainmeas
+def same_frequencies(freqs: np.ndarray, other: np.ndarray):
+    if len(freqs) != len(other):
+        return False
+    resolution = np.min(np.diff(freqs)) if len(freqs) > 1 else 1.0
+    return bool(np.all(np.abs(freqs - other) <= resolution * 1e-6))
 
 
-def integrate_amplitude_squared(measurement: pd.DataFrame, frequency_ranges: list):
-    intervals = []
-    for i, (start_freq, end_freq) in enumerate(frequency_ranges):
-        df = measurement[
-            (measurement["f"] > start_freq) & (measurement["f"] < end_freq)
-        ]
-        interval_df = (
-            df.groupby(["x", "y"])
-            .apply(lambda g: integrate.trapezoid(g.a**2, x=g.f), include_groups=False)
-            .reset_index()
-        )
-        intervals.append(interval_df)
-        intervals[i].columns = ["x", "y", "a"]
-    return intervals
+def match_axis(axis: np.ndarray, values: np.ndarray):
+    # index of every value on the axis, -1 where the axis has no such coordinate
+    idx = np.clip(np.searchsorted(axis, values), 0, len(axis) - 1)
+    below = np.clip(idx - 1, 0, len(axis) - 1)
+    idx = np.where(
+        np.abs(axis[below] - values) < np.abs(axis[idx] - values), below, idx
+    )
+    return np.where(np.abs(axis[idx] - values) <= COORDINATE_TOLERANCE, idx, -1)
+
 
+def trace_names(scan: Scan) -> list:
+    return as_dataset(scan).traces
 
-def integrate_amplitude_divide_pi(measurement: pd.DataFrame, frequency_ranges: list):
-    intervals = []
-    for i, (start_freq, end_freq) in enumerate(frequency_ranges):
-        df = measurement[
-            (measurement["f"] > start_freq) & (measurement["f"] < end_freq)
-        ]
-        interval_df = (
-            df.groupby(["x", "y"])
-            .apply(
-                lambda g: integrate.trapezoid(g.a, x=g.f) / np.pi,
-                include_groups=False,
+
+def select_trace(scan: Scan, trace: Optional[str]) -> Scan:
+    # a trace by its detector name, or the difference of two traces like
+    # POS-RMS, which stands out where the emissions are impulsive
+    if trace is None:
+        return scan
+    return as_dataset(scan).trace(trace).to_scan()
+
+
+def align_background(backmeas: Scan, mainmeas: Scan, mode: str = "auto") -> Scan:
+    for key in ("units", "detector"):
+        back_value = backmeas.metadata.get(key)
+        main_value = mainmeas.metadata.get(key)
+        if back_value and main_value and back_value != main_value:
+            print(
+                f"Background {key} {back_value} differs from measurement {main_value}"
             )
-            .reset_index()
+    freqs = np.asarray(mainmeas.freqs, dtype=np.float64)
+    back_freqs = np.asarray(backmeas.freqs, dtype=np.float64)
+    if freqs[0] < back_freqs[0] or freqs[-1] > back_freqs[-1]:
+        print("Background doesn't cover the whole measured span, extending its edges")
+
+    def on_measured_sweep(data):
+        data = np.asarray(data, dtype=np.float32)
+        if same_frequencies(back_freqs, freqs):
+            return data
+        return interpolate_frequencies(data, back_freqs, freqs)
+
+    captured = backmeas.mask.astype(bool)
+    if not captured.any():
+        raise ValueError("Background measurement doesn't contain any points")
+    average = on_measured_sweep(backmeas.data[captured].mean(axis=0))
+    xi = match_axis(backmeas.x, mainmeas.x)
+    yi = match_axis(backmeas.y, mainmeas.y)
+    # measured positions with a captured background point at the same coordinates
+    on_grid = np.outer(xi >= 0, yi >= 0)
+    on_grid[on_grid] = captured[np.ix_(xi[xi >= 0], yi[yi >= 0])].reshape(-1)
+    covered = bool(np.all(on_grid[mainmeas.mask.astype(bool)]))
+    if mode == "point" and not covered:
+        raise ValueError("Background grid doesn't contain every measured point")
+    if mode == "auto" and not covered:
+        print("Background grid doesn't match the measurement, using its average")
+    data = np.empty(mainmeas.shape, dtype=np.float32)
+    data[:] = average
+    if mode != "average" and covered:
+        rows, cols = np.nonzero(on_grid)
+        data[rows, cols] = on_measured_sweep(backmeas.data[xi[rows], yi[cols]])
+    arrays = {
+        "freqs": freqs,
+        "mask": np.ones(mainmeas.mask.shape, dtype=np.uint8),
+        "data": data,
+    }
+    metadata = dict(backmeas.metadata, background_mode=mode)
+    return Scan(mainmeas.x, mainmeas.y, arrays, metadata)
+
+
+def background_cache_key(
+    path: str, mainmeas: Scan, mode: str, trace: Optional[str] = None
+):
+    digest = hashlib.sha256(source_fingerprint(path).encode("utf-8"))
+    digest.update(mode.encode("utf-8"))
+    digest.update(str(trace).encode("utf-8"))
+    for axis in (mainmeas.x, mainmeas.y, mainmeas.freqs):
+        digest.update(np.ascontiguousarray(axis, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def load_background(
+    path: str,
+    mainmeas: Scan,
+    mode: str = "auto",
+    cache: Optional[StageCache] = None,
+    workers: Optional[int] = None,
+    trace: Optional[str] = None,
+) -> Scan:
+    def background():
+        backmeas = load_scan(path, workers, cache)
+        # the background is measured with the same detector where it has it
+        if trace is not None and set(trace.split("-")) <= set(trace_names(backmeas)):
+            backmeas = select_trace(backmeas, trace)
+        elif trace is not None:
+            print(f"Background has no trace {trace}, using its first trace")
+        return align_background(backmeas, mainmeas, mode)
+
+    return cached_scan(
+        cache,
+        "background",
+        background_cache_key(path, mainmeas, mode, trace),
+        background,
+    )
+
+
+def remove_background(backmeas: Scan, mainmeas: Scan, mode: str = "auto"):
+    if not (
+        np.array_equal(backmeas.x, mainmeas.x)
+        and np.array_equal(backmeas.y, mainmeas.y)
+        and np.array_equal(backmeas.freqs, mainmeas.freqs)
+    ):
+        backmeas = align_background(backmeas, mainmeas, mode)
+    arrays = dict(mainmeas.arrays, data=mainmeas.data - backmeas.data)
+    return Scan(mainmeas.x, mainmeas.y, arrays, mainmeas.metadata)
+
+
+def band_indices(freqs: np.ndarray, frequency_ranges: list):
+    # a band covers the samples strictly between its edges
+    edges = np.asarray(frequency_ranges, dtype=np.float64).reshape(-1, 2)
+    first = np.searchsorted(freqs, edges[:, 0], side="right")
+    last = np.searchsorted(freqs, edges[:, 1], side="left") - 1
+    return first, np.maximum(last, first)
+
+
+def integrate_bands(
+    measurement, frequency_ranges: list, integrand, chunk_size: int = 1 << 23
+):
+    # only the frequencies the bands cover are read from a scan or dataset
+    edges = np.asarray(frequency_ranges, dtype=np.float64)
+    dataset = as_dataset(measurement).frequencies(edges.min(), edges.max())
+    freqs = np.asarray(dataset.freqs, dtype=np.float64)
+    first, last = band_indices(freqs, frequency_ranges)
+    half_widths = np.diff(freqs) / 2.0
+    count_x, count_y, _ = dataset.shape
+    intervals = np.empty((len(first), count_x, count_y), dtype=np.float64)
+    # cumulative trapezoid sums let every band be read off with two lookups,
+    # the cube is walked once in blocks of rows to bound the float64 copy
+    for start, block in dataset.chunks(chunk_size):
+        values = integrand(np.asarray(block, np.float64))
+        cumulative = np.zeros(values.shape, dtype=np.float64)
+        np.cumsum(
+            (values[..., 1:] + values[..., :-1]) * half_widths,
+            axis=-1,
+            out=cumulative[..., 1:],
         )
-        intervals.append(interval_df)
-        intervals[i].columns = ["x", "y", "a"]
+        bands = cumulative[..., last] - cumulative[..., first]
+        intervals[:, start : start + len(block)] = np.moveaxis(bands, -1, 0)
+    intervals[:, dataset.mask == 0] = np.nan
     return intervals
 
 
-def measurement_interpolation(freq_intervals: list):
-    Xs = []
-    Ys = []
-    Zs = []
-    color_max = 0
-    color_min = np.inf
-    for df in freq_intervals:
-        if df["a"].min() < color_min:
-            color_min = df["a"].min()
-        if df["a"].max() > color_max:
-            color_max = df["a"].max()
-        x, y = get_meas_coords(df)
-        table = df.pivot(index="x", columns="y", values="a")
-        vals = table.values
-        new_size_x = len(x) * 120
-        new_size_y = len(y) * 120
-        interp_func = RectBivariateSpline(x, y, vals, kx=3, ky=3)
-        new_x = np.linspace(x[0], x[-1], new_size_x)
-        new_y = np.linspace(y[0], y[-1], new_size_y)
-        interpolated_vals = interp_func(new_x, new_y)
-        Y, X = np.meshgrid(new_y, new_x)
-        Xs.append(X)
-        Ys.append(Y)
-        Zs.append(interpolated_vals)
-    return Xs, Ys, Zs, color_max, color_min
-
-
-def show_interval_plots(Xs, Ys, Zs, color_max, color_min, titles, path):
-    i = 0
+def integrate_amplitude_squared(measurement, frequency_ranges: list):
+    return integrate_bands(measurement, frequency_ranges, np.square)
+
+
+def integrate_amplitude_divide_pi(measurement, frequency_ranges: list):
+    return integrate_bands(measurement, frequency_ranges, np.asarray) / np.pi
+
+
+aggregation_functions = {
+    "amplitude": integrate_amplitude_divide_pi,
+    "amplitude-squared": integrate_amplitude_squared,
+}
+
+
+def interpolation_axes(
+    x: np.ndarray, y: np.ndarray, pixel_size: float, max_size: Optional[int] = None
+):
+    # heatmaps get a square pixel every pixel_size mm, but never fewer than
+    # measured, capping the size grows the pixels so the aspect ratio is kept
+    extent = max(x[-1] - x[0], y[-1] - y[0])
+    if max_size is not None and extent / pixel_size + 1 > max_size:
+        pixel_size = extent / (max_size - 1)
+
+    def axis(values):
+        size = max(int(round((values[-1] - values[0]) / pixel_size)) + 1, len(values))
+        return np.linspace(values[0], values[-1], size)
+
+    return axis(x), axis(y)
+
+
+def band_batch_size(count: int, shape: tuple, value_size: int, memory: int) -> int:
+    return max(1, min(count, memory // (value_size * shape[0] * shape[1])))
+
+
+def spline_matrix(axis: np.ndarray, new_axis: np.ndarray) -> np.ndarray:
+    # an interpolating spline is linear in the data, so evaluating it on the
+    # new axis is a product with the splines through the unit vectors
+    k = min(SPLINE_DEGREE, len(axis) - 1)
+    if k < 1:
+        return np.ones((len(new_axis), len(axis)), dtype=np.float32)
+    basis = make_interp_spline(axis, np.eye(len(axis)), k=k)(new_axis)
+    return basis.astype(np.float32)
+
+
+def grid_interpolation(
+    x: np.ndarray,
+    y: np.ndarray,
+    freq_intervals,
+    new_x: np.ndarray,
+    new_y: np.ndarray,
+    memory: int = INTERPOLATION_MEMORY,
+):
+    # bicubic splines of every band are evaluated together as A @ Z @ B.T
+    x_matrix = spline_matrix(x, new_x)
+    y_matrix = spline_matrix(y, new_y).T.copy()
+    batch = band_batch_size(len(freq_intervals), (len(new_x), len(new_y)), 4, memory)
+    for start in range(0, len(freq_intervals), batch):
+        values = np.asarray(freq_intervals[start : start + batch], dtype=np.float32)
+        yield from x_matrix @ values @ y_matrix
+
+
+def scattered_interpolation(
+    x: np.ndarray,
+    y: np.ndarray,
+    freq_intervals,
+    new_x: np.ndarray,
+    new_y: np.ndarray,
+    memory: int = INTERPOLATION_MEMORY,
+):
+    # points missing from the grid, e.g. of an adaptive scan, are left out and
+    # batches of bands are interpolated over one shared triangulation of the rest
+    captured = ~np.isnan(freq_intervals).any(axis=0)
+    xi, yi = np.nonzero(captured)
+    triangulation = Delaunay(np.stack((x[xi], y[yi]), axis=1))
+    Y, X = np.meshgrid(new_y, new_x)
+    # the float64 result of the interpolators and its float32 copy
+    batch = band_batch_size(len(freq_intervals), (len(new_x), len(new_y)), 12, memory)
+    for start in range(0, len(freq_intervals), batch):
+        values = np.asarray(freq_intervals[start : start + batch])[:, xi, yi].T
+        interpolated_vals = CloughTocher2DInterpolator(triangulation, values)(X, Y)
+        outside = np.isnan(interpolated_vals[..., 0])
+        if outside.any():
+            nearest = NearestNDInterpolator(triangulation.points, values)
+            interpolated_vals[outside] = nearest(X[outside], Y[outside])
+        yield from np.moveaxis(interpolated_vals, -1, 0).astype(np.float32)
+
+
+def measurement_interpolation(
+    x: np.ndarray,
+    y: np.ndarray,
+    freq_intervals,
+    pixel_size: float = DEFAULT_PIXEL_SIZE,
+    memory: int = INTERPOLATION_MEMORY,
+):
+    # returns the axes shared by all bands and a generator of the interpolated
+    # bands, indexed [x, y], so only a batch of them is held in memory at once
+    color_max = np.nanmax(freq_intervals)
+    color_min = np.nanmin(freq_intervals)
+    if np.isnan(freq_intervals).any():
+        new_x, new_y = interpolation_axes(x, y, pixel_size, MAX_SCATTERED_SIZE)
+        Zs = scattered_interpolation(x, y, freq_intervals, new_x, new_y, memory)
+    else:
+        new_x, new_y = interpolation_axes(x, y, pixel_size)
+        Zs = grid_interpolation(x, y, freq_intervals, new_x, new_y, memory)
+    return new_x, new_y, Zs, color_max, color_min
+
+
+def overview_band(x: np.ndarray, y: np.ndarray, Z: np.ndarray):
+    # the overview only needs a few hundred pixels per band, a decimated copy
+    # lets the full resolution band be freed once it's been saved
+    stride = max(1, math.ceil(max(Z.shape) / OVERVIEW_SIZE))
+    return x[::stride], y[::stride], np.ascontiguousarray(Z[::stride, ::stride].T)
+
+
+def show_interval_plots(x, y, Zs, color_max, color_min, titles, path):
     subs_size = len(titles)
     plt_rows = math.ceil(subs_size / 5)
     fig, axs = plt.subplots(plt_rows, 5, figsize=(20, plt_rows * 4))
-    for i in range(0, len(Xs)):
+    for i, Z in enumerate(Zs):
         row = i // 5
         col = i % 5
-        if subs_size > 5:
-            pmesh = axs[row, col].pcolormesh(
-                Xs[i], Ys[i], Zs[i], vmax=color_max, vmin=color_min, shading="nearest"
-            )
-            axs[row, col].set_title(titles[i])
-            axs[row, col].xaxis.tick_bottom()
-            axs[row, col].xaxis.set_label_position("bottom")
-            axs[row, col].set_aspect("equal")
-            plt.gca().spines["bottom"].set_visible(False)
-            fig.colorbar(pmesh, ax=axs[row, col])
-        if subs_size <= 5:
-            pmesh = axs[col].pcolormesh(
-                Xs[i], Ys[i], Zs[i], vmax=color_max, vmin=color_min, shading="nearest"
-            )
-            axs[col].set_title(titles[i])
-            axs[col].xaxis.tick_bottom()
-            axs[col].xaxis.set_label_position("bottom")
-            axs[col].set_aspect("equal")
-            plt.gca().spines["bottom"].set_visible(False)
-            fig.colorbar(pmesh, ax=axs[col])
-        fig.savefig(path + "/out.png", bbox_inches="tight", pad_inches=0)
-        plt.title(titles[i])
-        plt.axis("off")
-        i += 1
-    plt.tight_layout()
-    plt.show()
-
-
-def save_heatmaps_color(Xs, Ys, Zs, color_max, color_min, titles, path):
-    i = 0
-    for i in range(0, len(Xs)):
-        fig = plt.figure()
-        ax = fig.add_subplot(1, 1, 1)
-        ax.pcolormesh(
-            Xs[i], Ys[i], Zs[i], vmax=color_max, vmin=color_min, shading="nearest"
+        ax = axs[row, col] if subs_size > 5 else axs[col]
+        pmesh = ax.pcolormesh(
+            *overview_band(x, y, Z), vmax=color_max, vmin=color_min, shading="nearest"
         )
+        ax.set_title(titles[i])
         ax.xaxis.tick_bottom()
         ax.xaxis.set_label_position("bottom")
         ax.set_aspect("equal")
         plt.gca().spines["bottom"].set_visible(False)
-        plt.axis("off")
-        fig.savefig(
-            f"{path}/color/{titles[i]}.png",
-            bbox_inches="tight",
-            pad_inches=0,
-            dpi=700,
-        )
-        i += 1
-
-
-def save_heatmaps_grey(Xs, Ys, Zs, color_max, color_min, titles, path):
-    i = 0
-    for i in range(0, len(Xs)):
-        fig = plt.figure()
-        ax = fig.add_subplot(1, 1, 1)
-        ax.pcolormesh(
-            Xs[i],
-            Ys[i],
-            Zs[i],
-            vmax=color_max,
-            vmin=color_min,
-            shading="nearest",
-            cmap="grey",
-        )
-        ax.xaxis.tick_bottom()
-        ax.xaxis.set_label_position("bottom")
-        ax.set_aspect("equal")
-        plt.gca().spines["bottom"].set_visible(False)
-        plt.axis("off")
-        fig.savefig(
-            f"{path}/grey/{titles[i]}_grey.png",
-            bbox_inches="tight",
-            pad_inches=0,
-            dpi=700,
-        )
-        i += 1
+        fig.colorbar(pmesh, ax=ax)
+    fig.savefig(path + "/out.png", bbox_inches="tight", pad_inches=0)
+    plt.tight_layout()
+    plt.show()
 
 
 def main():
@@ -232,13 +414,45 @@ def main():
         prog="emi collector",
         description="Take measurements with EMI-collector using this script. Make sure your CNC and SA are connected to your PC.",
     )
-    parser.add_argument("PATH", type=str, help="Path to measurement files")
+    parser.add_argument(
+        "PATH", type=str, help="Path to measurement files or to a scan file"
+    )
     parser.add_argument(
         "-b",
         "--remove-background",
         type=str,
         help="Add a path to measurement of background noise taken in the same frequency range to remove background from displayed heatmap",
     )
+    parser.add_argument(
+        "--background-mode",
+        type=str,
+        choices=["auto", "point", "average"],
+        help="Subtract the background point by point, subtract its spatial average, or pick automatically depending on whether its grid covers the measurement. Default is auto",
+        default="auto",
+    )
+    parser.add_argument(
+        "-t",
+        "--trace",
+        type=str,
+        help="Process this detector's trace of a scan captured with several detectors, or the difference of two traces like POS-RMS. Default is the first trace",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help=f"Directory for precomputed processing artifacts. Default is {DEFAULT_CACHE_DIR}",
+        default=DEFAULT_CACHE_DIR,
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        help=f"Size limit of the cache directory in MB, the least recently used results are evicted above it. Default is {DEFAULT_CACHE_SIZE >> 20}",
+        default=DEFAULT_CACHE_SIZE >> 20,
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write precomputed processing artifacts",
+    )
     parser.add_argument(
         "--heatmap-path",
         type=str,
@@ -249,7 +463,7 @@ def main():
         "-ag",
         "--aggregation",
         type=str,
-        choices=["amplitude", "amplitude-squared"],
+        choices=list(aggregation_functions),
         help="Choose a way to aggregate your data, you can integrate amplitude or amplitude squared over frequency interval. Default is amplitude",
         default="amplitude",
     )
@@ -260,37 +474,111 @@ def main():
         help="Choose a step of frequency intervals in Hz for heatmap generation. Default is 50000000",
         default=50000000.0,
     )
+    parser.add_argument(
+        "--pixel-size",
+        type=float,
+        help=f"Size of a heatmap pixel in mm. Default is {DEFAULT_PIXEL_SIZE}",
+        default=DEFAULT_PIXEL_SIZE,
+    )
+    parser.add_argument(
+        "--colormap",
+        type=str,
+        help=f"Matplotlib colormap of the colored heatmaps. Default is {COLOR_MAP}",
+        default=COLOR_MAP,
+    )
+    parser.add_argument(
+        "--heightmap-format",
+        type=str,
+        choices=["grey"] + list(heightmap_writers),
+        help="Save the field driving the 3D map's displacement as 8-bit grey PNGs, 16-bit PNGs, float EXR or NumPy heightmaps. Default is png16",
+        default="png16",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help="Number of processes parsing CSV measurement files and writing heatmaps. Default is the number of CPUs",
+    )
     args = parser.parse_args()
-    if os.path.isdir(args.PATH):
-        pass
-    else:
-        print(f"Path doesn't exist {args.PATH}")
+    for path in (args.PATH, args.remove_background):
+        if path is not None and not (os.path.isdir(path) or is_scan_file(path)):
+            print(f"Path doesn't exist {path}")
+            sys.exit()
+    cache = None if args.no_cache else StageCache(args.cache_dir, args.cache_size << 20)
+    meas = load_scan(args.PATH, args.workers, cache)
+    try:
+        meas = select_trace(meas, args.trace)
+    except (KeyError, ValueError) as e:
+        print(e.args[0])
         sys.exit()
-    if not os.path.exists(os.path.join(args.heatmap_path, "grey")):
-        os.makedirs(os.makedirs(os.path.join(args.heatmap_path, "grey")))
-    elif not os.path.exists(os.path.join(args.heatmap_path, "color")):
-        os.makedirs(os.path.join(args.heatmap_path, "color"))
-    meas = load_measurement(args.PATH)
-    freq_top = meas["f"].max()
-    freq_bot = meas["f"].min()
+    freq_top = meas.freqs.max()
+    freq_bot = meas.freqs.min()
     interval_list = define_ranges([freq_bot, freq_top], args.step)
     titles = define_plot_titles(interval_list)
-    measurement_intervals = pd.DataFrame()
+
+    # every stage is keyed by its parameters and the key of the stage before
+    # it, a run only computes the stages after the last one found in the cache
+    data_key = stage_key(source_fingerprint(args.PATH), args.trace)
     if args.remove_background is not None:
-        background = load_measurement(args.remove_background)
-        meas = remove_background(mainmeas=meas, backmeas=background)
-    if args.aggregation == "amplitude":
-        measurement_intervals = integrate_amplitude_divide_pi(
-            measurement=meas, frequency_ranges=interval_list
+        data_key = stage_key(
+            data_key, source_fingerprint(args.remove_background), args.background_mode
+        )
+
+    def corrected_measurement():
+        if args.remove_background is None:
+            return meas
+        return cached_scan(
+            cache,
+            "corrected",
+            data_key,
+            lambda: remove_background(
+                mainmeas=meas,
+                backmeas=load_background(
+                    args.remove_background,
+                    meas,
+                    args.background_mode,
+                    cache,
+                    args.workers,
+                    args.trace,
+                ),
+            ),
         )
-    if args.aggregation == "amplitude-squared":
-        measurement_intervals = integrate_amplitude_squared(
-            measurement=meas, frequency_ranges=interval_list
+
+    bands_key = stage_key(data_key, args.aggregation, interval_list)
+    measurement_intervals = cached_array(
+        cache,
+        "bands",
+        bands_key,
+        lambda: aggregation_functions[args.aggregation](
+            measurement=corrected_measurement(), frequency_ranges=interval_list
+        ),
+    )
+    new_x, new_y, interpolated, v_max, v_min = measurement_interpolation(
+        meas.x, meas.y, measurement_intervals, args.pixel_size
+    )
+    ZZ = cached_bands(
+        cache,
+        "interpolated",
+        # the constants change the interpolated bands as much as the arguments
+        stage_key(bands_key, args.pixel_size, MAX_SCATTERED_SIZE, SPLINE_DEGREE),
+        (len(titles), len(new_x), len(new_y)),
+        lambda: interpolated,
+    )
+    ZZ = write_heatmaps(
+        ZZ,
+        v_max,
+        v_min,
+        titles,
+        args.heatmap_path,
+        args.workers,
+        args.colormap,
+        args.heightmap_format,
+    )
+    if args.heightmap_format != "grey":
+        write_heightmap_metadata(
+            args.heatmap_path, args.heightmap_format, v_max, v_min, new_x, new_y, titles
         )
-    XX, YY, ZZ, v_max, v_min = measurement_interpolation(measurement_intervals)
-    show_interval_plots(XX, YY, ZZ, v_max, v_min, titles, args.heatmap_path)
-    save_heatmaps_grey(XX, YY, ZZ, v_max, v_min, titles, args.heatmap_path)
-    save_heatmaps_color(XX, YY, ZZ, v_max, v_min, titles, args.heatmap_path)
+    show_interval_plots(new_x, new_y, ZZ, v_max, v_min, titles, args.heatmap_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,231 @@
+import json
+import os
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+from matplotlib import colormaps
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+COLOR_MAP = "viridis"
+GREY_MAP = "grey"
+LUT_SIZE = 256
+# zlib level of the written PNGs, higher levels barely shrink smooth heatmaps
+PNG_COMPRESSION = 1
+HEIGHTMAP_DIR = "height"
+HEIGHTMAP_METADATA = "heightmap.json"
+
+# Heatmaps are written straight from the interpolated bands, one image pixel
+# per interpolated point: a band is quantized into colormap indices once and
+# looked up from precomputed tables. render_emimap.py loads the colored images
+# from color/<title>.png and drives the displacement either from the 8-bit
+# grey/<title>_grey.png or from a heightmap in height/, which holds the band
+# scaled by the global v_min and v_max of all bands into 0-1 at full precision.
+
+
+def colormap_lut(name: str, size: int = LUT_SIZE) -> np.ndarray:
+    return colormaps[name].resampled(size)(np.arange(size), bytes=True)[:, :3]
+
+
+def color_image_path(path: str, title: str) -> str:
+    return os.path.join(path, "color", f"{title}.png")
+
+
+def grey_image_path(path: str, title: str) -> str:
+    return os.path.join(path, "grey", f"{title}_grey.png")
+
+
+def heightmap_path(path: str, title: str, heightmap_format: str) -> str:
+    return os.path.join(
+        path, HEIGHTMAP_DIR, title + heightmap_extensions[heightmap_format]
+    )
+
+
+def make_heatmap_dirs(path: str, heightmap_format: str) -> None:
+    names = ["color", "grey" if heightmap_format == "grey" else HEIGHTMAP_DIR]
+    for name in names:
+        os.makedirs(os.path.join(path, name), exist_ok=True)
+
+
+def normalize_band(Z: np.ndarray, color_max: float, color_min: float) -> np.ndarray:
+    # bands are indexed [x, y], images have rows from the top of the board
+    scale = 1 / max(color_max - color_min, np.finfo(np.float32).tiny)
+    heights = np.nan_to_num((Z.T[::-1] - color_min) * scale, nan=0.0)
+    return np.ascontiguousarray(np.clip(heights, 0, 1), dtype=np.float32)
+
+
+def quantize_band(heights: np.ndarray, size: int = LUT_SIZE) -> np.ndarray:
+    return np.rint(heights * (size - 1)).astype(np.uint8)
+
+
+def write_png16(heights: np.ndarray, path: str, metadata: dict) -> None:
+    info = PngInfo()
+    for key, value in metadata.items():
+        info.add_text(key, str(value))
+    levels = np.rint(heights * 65535).astype(np.uint16)
+    Image.fromarray(levels, "I;16").save(
+        path, pnginfo=info, compress_level=PNG_COMPRESSION
+    )
+
+
+def _exr_attribute(name: str, kind: str, value: bytes) -> bytes:
+    return (
+        name.encode()
+        + b"\0"
+        + kind.encode()
+        + b"\0"
+        + struct.pack("<i", len(value))
+        + value
+    )
+
+
+def write_exr(heights: np.ndarray, path: str, metadata: dict) -> None:
+    # a single channel, uncompressed scanline OpenEXR file with 32-bit float
+    # luminance, which Blender loads as a non-color float image
+    height, width = heights.shape
+    window = struct.pack("<iiii", 0, 0, width - 1, height - 1)
+    header = [
+        _exr_attribute(
+            "channels", "chlist", b"Y\0" + struct.pack("<iB3xii", 2, 0, 1, 1) + b"\0"
+        ),
+        _exr_attribute("compression", "compression", b"\0"),
+        _exr_attribute("dataWindow", "box2i", window),
+        _exr_attribute("displayWindow", "box2i", window),
+        _exr_attribute("lineOrder", "lineOrder", b"\0"),
+        _exr_attribute("pixelAspectRatio", "float", struct.pack("<f", 1.0)),
+        _exr_attribute("screenWindowCenter", "v2f", struct.pack("<ff", 0.0, 0.0)),
+        _exr_attribute("screenWindowWidth", "float", struct.pack("<f", 1.0)),
+    ]
+    for key, value in metadata.items():
+        if isinstance(value, float):
+            header.append(_exr_attribute(key, "double", struct.pack("<d", value)))
+        else:
+            encoded = str(value).encode()
+            header.append(_exr_attribute(key, "string", encoded))
+    header = struct.pack("<ii", 20000630, 2) + b"".join(header) + b"\0"
+    line_size = 8 + 4 * width
+    offsets = len(header) + 8 * height + line_size * np.arange(height, dtype="<u8")
+    lines = np.empty((height, line_size), dtype=np.uint8)
+    lines[:, :4] = np.arange(height, dtype="<i4").view(np.uint8).reshape(-1, 4)
+    lines[:, 4:8] = np.frombuffer(struct.pack("<i", 4 * width), dtype=np.uint8)
+    lines[:, 8:] = heights.astype("<f4", copy=False).view(np.uint8)
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(offsets.tobytes())
+        f.write(lines.tobytes())
+
+
+def write_npy(heights: np.ndarray, path: str, metadata: dict) -> None:
+    # the metadata is only kept in heightmap.json
+    np.save(path, heights)
+
+
+heightmap_writers = {
+    "png16": write_png16,
+    "exr": write_exr,
+    "npy": write_npy,
+}
+heightmap_extensions = {
+    "png16": ".png",
+    "exr": ".exr",
+    "npy": ".npy",
+}
+
+
+def write_heightmap_metadata(
+    path: str,
+    heightmap_format: str,
+    color_max: float,
+    color_min: float,
+    x: np.ndarray,
+    y: np.ndarray,
+    titles: list,
+) -> None:
+    metadata = {
+        "format": heightmap_format,
+        "extension": heightmap_extensions[heightmap_format],
+        "v_min": float(color_min),
+        "v_max": float(color_max),
+        "x": [float(x[0]), float(x[-1])],
+        "y": [float(y[0]), float(y[-1])],
+        "size": [len(x), len(y)],
+        "bands": list(titles),
+    }
+    make_heatmap_dirs(path, heightmap_format)
+    with open(os.path.join(path, HEIGHTMAP_DIR, HEIGHTMAP_METADATA), "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def write_band_images(
+    Z: np.ndarray,
+    color_max: float,
+    color_min: float,
+    title: str,
+    path: str,
+    heightmap_format: str,
+    color_lut: np.ndarray,
+    grey_lut: np.ndarray,
+) -> None:
+    heights = normalize_band(Z, color_max, color_min)
+    indices = quantize_band(heights)
+    Image.fromarray(color_lut[indices], "RGB").save(
+        color_image_path(path, title), compress_level=PNG_COMPRESSION
+    )
+    if heightmap_format == "grey":
+        Image.fromarray(grey_lut[indices, 0], "L").save(
+            grey_image_path(path, title), compress_level=PNG_COMPRESSION
+        )
+    else:
+        heightmap_writers[heightmap_format](
+            heights,
+            heightmap_path(path, title, heightmap_format),
+            {"v_min": float(color_min), "v_max": float(color_max), "band": title},
+        )
+
+
+def write_heatmaps(
+    Zs,
+    color_max: float,
+    color_min: float,
+    titles: list,
+    path: str,
+    workers: Optional[int] = None,
+    color_map: str = COLOR_MAP,
+    heightmap_format: str = "grey",
+):
+    # a generator passing every band on once it's been queued for writing, so
+    # the bands can be streamed into the overview plot; only a few bands per
+    # worker wait for the pool at a time
+    make_heatmap_dirs(path, heightmap_format)
+    luts = (colormap_lut(color_map), colormap_lut(GREY_MAP))
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for title, Z in zip(titles, Zs):
+            write_band_images(
+                Z, color_max, color_min, title, path, heightmap_format, *luts
+            )
+            yield Z
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for title, Z in zip(titles, Zs):
+            pending.append(
+                pool.submit(
+                    write_band_images,
+                    Z,
+                    color_max,
+                    color_min,
+                    title,
+                    path,
+                    heightmap_format,
+                    *luts,
+                )
+            )
+            while len(pending) > 2 * workers:
+                pending.popleft().result()
+            yield Z
+        for future in pending:
+            future.result()
@@ -0,0 +1,132 @@
+import os
+import time
+from typing import Optional
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from data_process import aggregation_functions, define_plot_titles, define_ranges
+from scan_file import Scan
+
+PREVIEW_NAME = "preview.png"
+
+# The preview keeps the band integrals of every measured point in a grid with
+# NaN for the points still to come. A new point is integrated on its own and
+# written into its cell, so its cost doesn't depend on how much of the scan is
+# done; the figure is redrawn at most once per interval.
+
+
+class LivePreview:
+    def __init__(
+        self,
+        x_positions: list,
+        y_positions: list,
+        start: float,
+        stop: float,
+        step: float,
+        aggregation: str = "amplitude",
+        mode: str = "window",
+        path: Optional[str] = None,
+        interval: float = 2.0,
+    ):
+        if mode == "png":
+            plt.switch_backend("Agg")
+        self.x = np.asarray(x_positions, dtype=np.float64)
+        self.y = np.asarray(y_positions, dtype=np.float64)
+        self.index = {
+            (x_pos, y_pos): (i, j)
+            for i, x_pos in enumerate(x_positions)
+            for j, y_pos in enumerate(y_positions)
+        }
+        self.start = start
+        self.stop = stop
+        self.ranges = define_ranges([start, stop], step)
+        self.titles = define_plot_titles(self.ranges)
+        self.aggregate = aggregation_functions[aggregation]
+        self.grid = np.full((len(self.ranges), len(self.x), len(self.y)), np.nan)
+        # the trace length is only known after the first sweep
+        self.freqs = None
+        self.mode = mode
+        self.path = path
+        self.interval = interval
+        self.drawn = 0.0
+        self.points = 0
+        self._create_figure()
+
+    def _create_figure(self) -> None:
+        if self.mode == "window":
+            plt.ion()
+        self.fig, (self.total_ax, self.band_ax) = plt.subplots(1, 2, figsize=(12, 5))
+        # cell centres on the measured positions, like the pcolormesh plots
+        pitch_x = self.x[1] - self.x[0] if len(self.x) > 1 else 1.0
+        pitch_y = self.y[1] - self.y[0] if len(self.y) > 1 else 1.0
+        extent = (
+            self.x[0] - pitch_x / 2,
+            self.x[-1] + pitch_x / 2,
+            self.y[0] - pitch_y / 2,
+            self.y[-1] + pitch_y / 2,
+        )
+        empty = np.full((len(self.y), len(self.x)), np.nan)
+        self.total_image = self.total_ax.imshow(
+            empty, origin="lower", extent=extent, interpolation="nearest"
+        )
+        self.band_image = self.band_ax.imshow(
+            empty, origin="lower", extent=extent, interpolation="nearest"
+        )
+        self.total_ax.set_title("Whole span")
+        self.fig.colorbar(self.total_image, ax=self.total_ax)
+        self.fig.colorbar(self.band_image, ax=self.band_ax)
+
+    def add_point(self, x_pos: float, y_pos: float, trace: np.ndarray) -> None:
+        i, j = self.index[(x_pos, y_pos)]
+        if self.freqs is None:
+            self.freqs = np.linspace(self.start, self.stop, len(trace))
+        point = Scan(
+            [x_pos],
+            [y_pos],
+            {
+                "freqs": self.freqs,
+                "mask": np.ones((1, 1), dtype=np.uint8),
+                "data": np.asarray(trace).reshape(1, 1, -1),
+            },
+        )
+        self.grid[:, i, j] = self.aggregate(
+            measurement=point, frequency_ranges=self.ranges
+        )[:, 0, 0]
+        self.points += 1
+        if time.monotonic() - self.drawn >= self.interval:
+            self.draw()
+
+    def _show(self, image, values: np.ndarray) -> None:
+        image.set_data(values.T)
+        if not np.isnan(values).all():
+            image.set_clim(np.nanmin(values), np.nanmax(values))
+
+    def draw(self) -> None:
+        if self.points == 0:
+            return
+        self._show(self.total_image, self.grid.sum(axis=0))
+        # the band whose field varies the most over the board so far, bands
+        # differ in width so the spread is relative to the band's maximum
+        highest = np.nanmax(self.grid, axis=(1, 2))
+        spread = (highest - np.nanmin(self.grid, axis=(1, 2))) / np.abs(highest)
+        band = int(np.nanargmax(spread))
+        self._show(self.band_image, self.grid[band])
+        self.band_ax.set_title(self.titles[band])
+        self.fig.suptitle(f"{self.points} points measured")
+        if self.mode == "window":
+            self.fig.canvas.draw_idle()
+            plt.pause(0.001)
+        else:
+            # replaced at once, so image viewers never see a half written file
+            target = os.path.join(self.path, PREVIEW_NAME)
+            partial = target + ".part.png"
+            self.fig.savefig(partial)
+            os.replace(partial, target)
+        self.drawn = time.monotonic()
+
+    def close(self) -> None:
+        self.draw()
+        if self.mode == "window":
+            plt.ioff()
+        plt.close(self.fig)
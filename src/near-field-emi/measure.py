@@ -4,8 +4,50 @@ import vector
 import logging
 import argparse
 import os
+import numpy as np
 from control.SA import *
 from control.CNC import *
+from acquisition import CsvSink, PointWriter, ScanSink, parse_blocks
+from scan_file import SCAN_SUFFIX
+from scan_path import (
+    DEFAULT_FEEDRATE,
+    path_planners,
+    plan_path,
+    plan_summary,
+)
+from adaptive_scan import (
+    DEFAULT_REFINE_THRESHOLD,
+    AdaptivePlanner,
+    lattice_stride,
+    point_power,
+    score_functions,
+)
+from scan_journal import create_journal, journal_exists, load_journal
+from control.simulator import FieldModel, SimulatedBench
+from sweep_stats import SweepStatistics, statistic_traces
+from segmented_sweep import SegmentedSweep
+
+# arguments which define the scan itself, --resume takes them from the journal
+RESUMED_ARGUMENTS = [
+    "x",
+    "y",
+    "step",
+    "offset",
+    "frequency_range",
+    "units",
+    "detectors",
+    "sweeps",
+    "sweep_tolerance",
+    "segments",
+    "segment_rbw",
+    "output_format",
+    "path",
+    "adaptive",
+    "min_step",
+    "refine_score",
+    "refine_threshold",
+    "time_budget",
+]
 
 
 def main():
@@ -64,9 +106,135 @@ def main():
         "-d",
         "--detectors",
         type=str,
+        nargs="+",
         choices=["POS", "RMS", "QUASI"],
-        help="Choose a spectrum analyser's peak detector type for the measurement.",
-        default="POS",
+        help="Choose a spectrum analyser's peak detector type for the measurement. Several detectors are captured as separate traces of the same sweep. Default is POS",
+        default=["POS"],
+    )
+    parser.add_argument(
+        "-n",
+        "--sweeps",
+        type=int,
+        help="Take up to this many sweeps at every point and save their mean, max-hold, min and variance. Default is 1",
+        default=1,
+    )
+    parser.add_argument(
+        "--sweep-tolerance",
+        type=float,
+        help="Stop sweeping a point once its mean variance changes by less than this fraction with a new sweep, 0 always takes all sweeps. Default is 0.05",
+        default=0.05,
+    )
+    parser.add_argument(
+        "--segments",
+        type=int,
+        help="Sweep the frequency range as this many consecutive sub-spans at every point and stitch them, multiplying the frequency resolution. Default is 1",
+        default=1,
+    )
+    parser.add_argument(
+        "--segment-rbw",
+        type=float,
+        help="RBW in Hz of the segments of a segmented sweep. Default is the SA's RBW coupled to the segment span",
+    )
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        choices=["csv", "scan"],
+        help=f"Save every point as a separate CSV file or write all points into a single {SCAN_SUFFIX} scan file in PATH. Default is csv.",
+        default="csv",
+    )
+    parser.add_argument(
+        "-p",
+        "--path",
+        type=str,
+        choices=list(path_planners),
+        help="Choose the order in which the probe visits the points. Default is serpentine",
+        default="serpentine",
+    )
+    parser.add_argument(
+        "--feedrate",
+        type=float,
+        help=f"Plotter feed rate in mm/min used to estimate the scan time. Default is {DEFAULT_FEEDRATE:.0f}",
+        default=DEFAULT_FEEDRATE,
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        help="Time in seconds to let the probe settle after the plotter reports the move as complete. Default is 0.5",
+        default=0.5,
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        help="Maximum number of read spectra waiting to be saved in the background. Default is 64",
+        default=64,
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Measure the --step grid first and then refine only the cells with the strongest emissions",
+    )
+    parser.add_argument(
+        "--min-step",
+        type=float,
+        help="Smallest step in mm an adaptive scan refines down to. Default is 1",
+        default=1.0,
+    )
+    parser.add_argument(
+        "--refine-score",
+        type=str,
+        choices=list(score_functions),
+        help="Score adaptive scan cells by the power difference between their corners or by their highest power. Default is gradient",
+        default="gradient",
+    )
+    parser.add_argument(
+        "--refine-threshold",
+        type=float,
+        help=f"Refine adaptive scan cells scoring at least this fraction of the best coarse cell. Default is {DEFAULT_REFINE_THRESHOLD}",
+        default=DEFAULT_REFINE_THRESHOLD,
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        help="Stop refining an adaptive scan after this many seconds",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted scan in PATH with the parameters recorded in its journal, skipping points which were already saved",
+    )
+    parser.add_argument(
+        "--preview",
+        type=str,
+        choices=["window", "png"],
+        help="Show a heatmap of the points measured so far in a window or keep writing it to preview.png in PATH",
+    )
+    parser.add_argument(
+        "--preview-interval",
+        type=float,
+        help="Minimum time in seconds between preview refreshes. Default is 2",
+        default=2.0,
+    )
+    parser.add_argument(
+        "--preview-step",
+        type=float,
+        help="Frequency step in Hz of the preview's bands. Default is 50000000",
+        default=50000000.0,
+    )
+    parser.add_argument(
+        "--simulate",
+        action="store_true",
+        help="Run the scan against simulated plotter and SA, SAaddr and CNC are ignored",
+    )
+    parser.add_argument(
+        "--sim-time-scale",
+        type=float,
+        help="Multiply every simulated delay by this factor, 0 runs the simulation as fast as possible. Default is 1",
+        default=1.0,
+    )
+    parser.add_argument(
+        "--sim-field",
+        type=str,
+        help="JSON file with the FieldModel parameters of the simulated board",
     )
     args = parser.parse_args()
     path_dir = args.PATH
@@ -82,6 +250,31 @@ def main():
             logger.error(f"Couldn't create {path_dir}")
             sys.exit()
 
+    journal = None
+    if args.resume:
+        if not journal_exists(path_dir):
+            print(f"No scan journal found in {path_dir}, nothing to resume")
+            sys.exit()
+        journal = load_journal(path_dir)
+        # journals of older scans don't record the later arguments
+        for name in RESUMED_ARGUMENTS:
+            setattr(args, name, journal.params.get(name, getattr(args, name)))
+        print(f"Resuming scan with {len(journal.points)} points already saved")
+    elif journal_exists(path_dir):
+        print(f"{path_dir} holds a journal of another scan, continue it with --resume")
+        sys.exit()
+    # journals of single detector scans hold the detector name alone
+    detectors = [args.detectors] if isinstance(args.detectors, str) else args.detectors
+    if len(set(detectors)) != len(detectors) or len(detectors) > 3:
+        print("Choose up to 3 different detectors, one per trace")
+        sys.exit()
+    if args.sweeps < 1:
+        print("Take at least one sweep per point")
+        sys.exit()
+    if args.segments < 1:
+        print("Sweep at least one segment per point")
+        sys.exit()
+
     ## get the offset from arg
     offsets = args.offset
     unit_functions = {
@@ -109,32 +302,62 @@ def main():
     COUNT_X = int(args.x / STEP_X)
     COUNT_Y = int(args.y / STEP_Y)
 
-    ports = serial.tools.list_ports.comports()
-    for port, desc, hwid in sorted(ports):
-        print(port, args.CNC)
-        if args.CNC in port:
-            PRINTER_DEVICE = port
-        print("{}: {} [{}]".format(port, desc, hwid))
-    if PRINTER_DEVICE == "":
-        print("CNC not found, exiting")
-        sys.exit()
-
-    instr = init_instrument(SA_ADDRESS)
-    plotter = init_plotter(PRINTER_DEVICE)
+    if args.simulate:
+        field = FieldModel.load(args.sim_field) if args.sim_field else FieldModel()
+        bench = SimulatedBench(field, args.sim_time_scale, args.feedrate)
+        sleep = bench.sleep
+    else:
+        sleep = time.sleep
+        ports = serial.tools.list_ports.comports()
+        for port, desc, hwid in sorted(ports):
+            print(port, args.CNC)
+            if args.CNC in port:
+                PRINTER_DEVICE = port
+            print("{}: {} [{}]".format(port, desc, hwid))
+        if PRINTER_DEVICE == "":
+            print("CNC not found, exiting")
+            sys.exit()
 
-    ## measurement settings
-    selected_det = detector_functions.get(args.detectors)
-    if selected_det:
-        selected_det(instr)
+    # the probe is still where an interrupted scan last sent it
+    last_position = None
+    if journal is not None:
+        last_move = journal.last_move or journal.home
+        last_position = vector.obj(x=last_move[0], y=last_move[1], z=last_move[2])
+    if args.simulate:
+        instr = setup_instrument(bench.instrument)
+        plotter = setup_plotter(bench.plotter, last_position)
     else:
-        print("Invalid detector specified")
-    selected_unit = unit_functions.get(args.units)
-    if selected_unit:
-        selected_unit(instr)
+        instr = init_instrument(SA_ADDRESS)
+        plotter = init_plotter(PRINTER_DEVICE, last_position)
+
+    ## measurement settings, sent as one message and checked for errors once
+    with instr.batch():
+        # several detectors are switched between the sweeps of every point
+        selected_det = detector_functions.get(detectors[0])
+        if selected_det:
+            selected_det(instr)
+        else:
+            print("Invalid detector specified")
+        selected_unit = unit_functions.get(args.units)
+        if selected_unit:
+            selected_unit(instr)
+        else:
+            print("Invalid unit specified")
+        set_frequency_span(instr, freq_min, freq_max)
+        set_single_sweep(instr)
+    traces = detectors if len(detectors) > 1 else None
+    if args.sweeps > 1:
+        traces = statistic_traces(detectors)
+    sweep_time = query_sweep_time(instr)
+    if journal is not None:
+        start_pos = vector.obj(x=journal.home[0], y=journal.home[1], z=journal.home[2])
     else:
-        print("Invalid unit specified")
-    set_frequency_span(instr, freq_min, freq_max)
-    start_pos = get_plotter_position(plotter)
+        start_pos = get_plotter_position(plotter)
+        journal = create_journal(
+            path_dir,
+            {name: getattr(args, name) for name in RESUMED_ARGUMENTS},
+            [start_pos.x, start_pos.y, start_pos.z],
+        )
     offset_pos = vector.obj(
         x=start_pos.x + offsets[0],
         y=start_pos.y + offsets[1],
@@ -143,25 +366,223 @@ def main():
 
     # taking the measurements
     start, stop = query_frequency_span(instr)
-    moveAbs_plotter_to(plotter, offset_pos)
-
-    # equally distributed points accros the board with a STEP
-    for x in range(COUNT_X):
-        for y in range(COUNT_Y):
-            x_pos = STEP_X * x + offset_pos.x
-            y_pos = STEP_Y * y + offset_pos.y
-            moveAbs_plotter_to(plotter, vector.obj(x=x_pos, y=y_pos, z=offset_pos.z))
-            time.sleep(3)
-            # saving measurement data
-            data = query_spectrum(instr)
-            save_data(
-                data,
-                start,
-                stop,
-                Path(os.path.join(path_dir, f"x{x_pos}_y{y_pos}.csv")),
-            )
+    segmented = None
+    if args.segments > 1:
+        segmented = SegmentedSweep(instr, start, stop, args.segments, args.segment_rbw)
+        sweep_time = segmented.sweep_time()
+        print(segmented.summary())
+    journal.record_move(offset_pos.x, offset_pos.y, offset_pos.z)
+    # streamed ahead, the first point's move waits for both to finish
+    moveAbs_plotter_to(plotter, offset_pos, wait=False)
+
+    # equally distributed points accros the board with a STEP, adaptive scans
+    # place their refined points on a lattice dividing the step by a power of 2
+    # each axis is refined down to --min-step on its own
+    stride_x, stride_y = (
+        (lattice_stride(STEP_X, args.min_step), lattice_stride(STEP_Y, args.min_step))
+        if args.adaptive
+        else (1, 1)
+    )
+    x_positions = [
+        STEP_X / stride_x * x + offset_pos.x
+        for x in range((COUNT_X - 1) * stride_x + 1)
+    ]
+    y_positions = [
+        STEP_Y / stride_y * y + offset_pos.y
+        for y in range((COUNT_Y - 1) * stride_y + 1)
+    ]
+    planner = AdaptivePlanner(
+        x_positions,
+        y_positions,
+        (stride_x, stride_y),
+        args.refine_threshold,
+        args.refine_score,
+    )
+    scan_metadata = {
+        "units": args.units,
+        "detector": detectors[0],
+        "rbw": query_RBW(instr),
+        "step": [STEP_X, STEP_Y],
+        "adaptive": args.adaptive,
+        "min_step": [STEP_X / stride_x, STEP_Y / stride_y],
+        "offset": offsets,
+        "board": [args.x, args.y],
+        "frequency_range": [start, stop],
+        "settle": args.settle,
+        "sweep_time": sweep_time,
+        "sweeps": args.sweeps,
+        "segments": args.segments,
+        "simulated": args.simulate,
+    }
+    path, summary = plan_summary(
+        planner.initial_points(),
+        args.path,
+        args.feedrate,
+        # an upper bound when the sweeps of a point stop early
+        args.settle + args.sweeps * len(detectors) * sweep_time,
+        (start_pos.x, start_pos.y),
+    )
+    print(summary)
+    if args.output_format == "scan":
+        sink = ScanSink(
+            os.path.join(path_dir, "scan" + SCAN_SUFFIX),
+            x_positions,
+            y_positions,
+            start,
+            stop,
+            scan_metadata,
+            append=args.resume,
+            traces=traces,
+        )
+    else:
+        sink = CsvSink(path_dir, start, stop, traces)
+
+    detector_order = list(range(len(detectors)))
+
+    def measure_point(x_pos, y_pos):
+        moved = time.monotonic()
+        journal.record_move(x_pos, y_pos, offset_pos.z)
+        # returns once the plotter acknowledges M400, i.e. the probe has stopped
+        moveAbs_plotter_to(plotter, vector.obj(x=x_pos, y=y_pos, z=offset_pos.z))
+        settled = time.monotonic()
+        sleep(args.settle)
+        stages = {
+            "motion": settled - moved,
+            "settle": time.monotonic() - settled,
+            "sweep": 0.0,
+            "readout": 0.0,
+        }
+
+        def read_sweep(duration):
+            # a sweep of TRACE1 per detector, in detector order
+            blocks = [None] * len(detectors)
+            for index in detector_order:
+                if len(detectors) > 1:
+                    set_detector(instr, detectors[index])
+                stages["sweep"] += trigger_sweep(instr, duration)
+                read = time.monotonic()
+                blocks[index] = read_spectrum_block(instr)
+                stages["readout"] += time.monotonic() - read
+            # the next sweep starts with the detector this one ended with, so
+            # the SA switches detectors once less
+            detector_order.reverse()
+            return blocks
+
+        statistics = SweepStatistics()
+        tuning = segmented.tuning if segmented is not None else 0.0
+        for _ in range(args.sweeps):
+            # segments are parsed and stitched right away, plain sweeps are
+            # parsed by the writer
+            if segmented is None:
+                spectra = read_sweep(sweep_time)
+            else:
+                spectra = segmented.sweep(read_sweep)
+            if args.sweeps == 1:
+                break
+            # reduced at once, the memory taken doesn't grow with the sweeps
+            statistics.add(parse_blocks(spectra))
+            if statistics.converged(args.sweep_tolerance):
+                break
+        if segmented is not None:
+            stages["tune"] = segmented.tuning - tuning
+        logger.info(
+            "Point x:%s y:%s waited: motion %.2f s, settle %.2f s, sweep %.2f s, readout %.2f s",
+            x_pos,
+            y_pos,
+            stages["motion"],
+            stages["settle"],
+            stages["sweep"],
+            stages["readout"],
+        )
+        if args.sweeps == 1:
+            return spectra, stages
+        stages["sweeps"] = statistics.count
+        return statistics.result(), stages
+
+    preview = None
+    if args.preview is not None:
+        # the preview needs the processing stack, plain scans don't load it
+        from live_preview import LivePreview
+
+        preview = LivePreview(
+            x_positions,
+            y_positions,
+            start,
+            stop,
+            args.preview_step,
+            mode=args.preview,
+            path=path_dir,
+            interval=args.preview_interval,
+        )
+
+    # traces are parsed and saved in the background while the plotter moves on,
+    # a point is journaled as done only once its data has been saved
+    scan_started = time.monotonic() - sum(journal.durations)
+    measured = 0
+    refining = False
+    # points are counted as they're queued, the journal lags behind the writer
+    queued = len(journal.points)
+    try:
+        with PointWriter(sink, args.queue_size, journal.record_point) as writer:
+            while len(path):
+                total = queued + sum(
+                    not journal.is_done(x, y) for x, y in path.tolist()
+                )
+                for x_pos, y_pos in path.tolist():
+                    if journal.is_done(x_pos, y_pos):
+                        if args.adaptive:
+                            record = journal.points[(x_pos, y_pos)]
+                            planner.record(x_pos, y_pos, record["level"])
+                        continue
+                    # the coarse grid is always completed, only refinement is cut short
+                    if (
+                        refining
+                        and args.time_budget is not None
+                        and time.monotonic() - scan_started > args.time_budget
+                    ):
+                        print("Time budget exceeded, stopping refinement")
+                        path = []
+                        break
+                    point_started = time.monotonic()
+                    spectra, stages = measure_point(x_pos, y_pos)
+                    record = {"duration": time.monotonic() - point_started, **stages}
+                    measured += 1
+                    # refinement and preview follow the first detector, or its mean,
+                    # a stitched sweep of a single detector is a single trace
+                    if args.adaptive or preview is not None:
+                        data = np.atleast_2d(parse_blocks(spectra))[0]
+                    if args.adaptive:
+                        freqs = calculate_frequencies(start, stop, len(data))
+                        record["level"] = point_power(data, freqs, args.units)
+                        planner.record(x_pos, y_pos, record["level"])
+                    if preview is not None:
+                        preview.add_point(x_pos, y_pos, data)
+                    writer.put(x_pos, y_pos, spectra, record)
+                    queued += 1
+                    logger.info(journal.progress(queued, total))
+                else:
+                    refined = planner.next_points() if args.adaptive else []
+                    path = (
+                        plan_path(refined, args.path, (x_pos, y_pos)) if refined else []
+                    )
+                    refining = True
+    finally:
+        # an interrupted scan still closes the window and writes the last PNG
+        if preview is not None:
+            preview.close()
+    if args.adaptive:
+        print(
+            f"Adaptive scan measured {measured} of {len(x_positions) * len(y_positions)} points"
+        )
+    if segmented is not None:
+        set_frequency_span(instr, start, stop)
+    set_continuous_sweep(instr)
     # going back to home
+    journal.record_move(start_pos.x, start_pos.y, start_pos.z)
     moveAbs_plotter_to(plotter, start_pos)
+    logger.debug("Plotter round trips:\n%s", plotter.timing_summary())
+    logger.debug("SA query latencies:\n%s", instr.latency_summary())
+    journal.close()
 
 
 if __name__ == "__main__":
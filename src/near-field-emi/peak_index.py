@@ -0,0 +1,363 @@
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from data_process import load_background, load_scan, select_trace
+from scan_file import SCAN_SUFFIX, Scan, is_scan_file
+from stage_cache import DEFAULT_CACHE_DIR, StageCache
+
+INDEX_NAME = "peaks.npz"
+# bins on each side of a peak its prominence is measured over
+PROMINENCE_WINDOW = 10
+
+# Peaks are the local maxima of every point's spectrum which stand out by a
+# threshold above the floor, the point's median level or the background
+# measured at it, and by a prominence above the lowest levels within a window
+# on both sides. The index keeps the peaks sorted by frequency bin and by
+# level within a bin, with the offset of every bin's first peak, so a
+# frequency or a band resolves into a slice of the arrays without the scan.
+
+
+def point_floor(spectra: np.ndarray) -> np.ndarray:
+    return np.median(spectra, axis=-1, keepdims=True)
+
+
+def find_peaks(
+    spectra: np.ndarray,
+    floor: np.ndarray,
+    threshold: float,
+    prominence: float,
+    window: int = PROMINENCE_WINDOW,
+) -> tuple:
+    # spectra of any number of points along the last axis, returns the point
+    # and bin indices of the peaks with their levels and prominences
+    spectra = np.asarray(spectra, dtype=np.float32)
+    padded = np.pad(spectra, [(0, 0)] * (spectra.ndim - 1) + [(window, window)], "edge")
+    lowest = sliding_window_view(padded, window, axis=-1).min(axis=-1)
+    count = spectra.shape[-1]
+    base = np.maximum(lowest[..., :count], lowest[..., window + 1 : window + 1 + count])
+    rising = np.zeros(spectra.shape, dtype=bool)
+    rising[..., 1:-1] = (spectra[..., 1:-1] > spectra[..., :-2]) & (
+        spectra[..., 1:-1] >= spectra[..., 2:]
+    )
+    found = rising & (spectra - floor >= threshold) & (spectra - base >= prominence)
+    *point, bins = np.nonzero(found)
+    return (
+        tuple(point),
+        bins,
+        spectra[found],
+        (spectra - base)[found],
+    )
+
+
+def extract_peaks(
+    scan: Scan,
+    threshold: float,
+    prominence: float,
+    background: Optional[Scan] = None,
+    window: int = PROMINENCE_WINDOW,
+) -> dict:
+    # a row of points at a time, so the cube never has to fit in memory
+    columns = {name: [] for name in ("bin", "x", "y", "level", "prominence")}
+    for i, x_pos in enumerate(scan.x):
+        measured = scan.mask[i].astype(bool)
+        if not measured.any():
+            continue
+        spectra = np.asarray(scan.data[i][measured])
+        if background is None:
+            floor = point_floor(spectra)
+        else:
+            floor = np.asarray(background.data[i][measured])
+        (point,), bins, levels, prominences = find_peaks(
+            spectra, floor, threshold, prominence, window
+        )
+        columns["bin"].append(bins)
+        columns["x"].append(np.full(len(bins), x_pos))
+        columns["y"].append(scan.y[measured][point])
+        columns["level"].append(levels)
+        columns["prominence"].append(prominences)
+    dtypes = {"bin": np.int32, "x": np.float32, "y": np.float32}
+    return {
+        name: (
+            np.concatenate(values).astype(dtypes.get(name, np.float32))
+            if values
+            else np.empty(0, dtype=dtypes.get(name, np.float32))
+        )
+        for name, values in columns.items()
+    }
+
+
+def build_index(peaks: dict, freqs: np.ndarray, metadata: dict) -> "PeakIndex":
+    order = np.lexsort((-peaks["level"], peaks["bin"]))
+    columns = {name: values[order] for name, values in peaks.items()}
+    offsets = np.searchsorted(columns["bin"], np.arange(len(freqs) + 1))
+    return PeakIndex(np.asarray(freqs, dtype=np.float64), offsets, columns, metadata)
+
+
+def default_index_path(path: str) -> str:
+    if is_scan_file(path):
+        return path[: -len(SCAN_SUFFIX)] + "." + INDEX_NAME
+    return os.path.join(path, INDEX_NAME)
+
+
+class PeakIndex:
+    def __init__(self, freqs: np.ndarray, offsets: np.ndarray, columns: dict, metadata):
+        self.freqs = freqs
+        self.offsets = offsets
+        self.columns = columns
+        self.metadata = metadata
+
+    @classmethod
+    def load(cls, path: str) -> "PeakIndex":
+        with np.load(path) as stored:
+            columns = {
+                name[len("peak_") :]: stored[name]
+                for name in stored.files
+                if name.startswith("peak_")
+            }
+            metadata = json.loads(str(stored["metadata"]))
+            return cls(stored["freqs"], stored["offsets"], columns, metadata)
+
+    def save(self, path: str) -> None:
+        # written under a temporary name, queries never see a partial index
+        partial = path + ".part.npz"
+        np.savez(
+            partial,
+            freqs=self.freqs,
+            offsets=self.offsets,
+            metadata=np.array(json.dumps(self.metadata)),
+            **{"peak_" + name: values for name, values in self.columns.items()},
+        )
+        os.replace(partial, path)
+
+    def __len__(self) -> int:
+        return len(self.columns["bin"])
+
+    def _entries(self, first: int, last: int) -> dict:
+        return {
+            name: values[self.offsets[first] : self.offsets[last]]
+            for name, values in self.columns.items()
+        }
+
+    def _bins(self, low: float, high: float) -> tuple:
+        first = int(np.searchsorted(self.freqs, low, side="left"))
+        last = int(np.searchsorted(self.freqs, high, side="right"))
+        return first, max(first, last)
+
+    def _rank_locations(self, entries: dict, top: Optional[int]) -> dict:
+        # the strongest peak of every location, strongest locations first
+        order = np.argsort(-entries["level"], kind="stable")
+        ranked = {name: values[order] for name, values in entries.items()}
+        _, first = np.unique(
+            np.stack((ranked["x"], ranked["y"]), axis=1), axis=0, return_index=True
+        )
+        keep = np.sort(first)[:top]
+        return {name: values[keep] for name, values in ranked.items()}
+
+    def spot(
+        self, frequency: float, tolerance: Optional[float] = None, top=None
+    ) -> dict:
+        # a harmonic may peak in a neighbouring bin at some points, so the bins
+        # within a tolerance, by default one bin width, are looked up together
+        if tolerance is None:
+            tolerance = (self.freqs[-1] - self.freqs[0]) / max(len(self.freqs) - 1, 1)
+        entries = self._entries(
+            *self._bins(frequency - tolerance, frequency + tolerance)
+        )
+        return self._rank_locations(entries, top)
+
+    def band(self, low: float, high: float, top=None) -> dict:
+        return self._rank_locations(self._entries(*self._bins(low, high)), top)
+
+    def top(self, count: int) -> dict:
+        # the strongest location of every bin, i.e. the first peak of the bin,
+        # for the bins with the strongest peaks
+        first = self.offsets[:-1][np.diff(self.offsets) > 0]
+        strongest = first[np.argsort(-self.columns["level"][first], kind="stable")]
+        return {
+            name: values[strongest[:count]] for name, values in self.columns.items()
+        }
+
+
+def format_entries(index: PeakIndex, entries: dict) -> str:
+    units = index.metadata.get("units") or ""
+    lines = [
+        f"{'frequency':>14} {'x [mm]':>8} {'y [mm]':>8} {'level':>10} {'prominence':>11}"
+    ]
+    for bin_, x_pos, y_pos, level, prominence in zip(
+        entries["bin"],
+        entries["x"],
+        entries["y"],
+        entries["level"],
+        entries["prominence"],
+    ):
+        lines.append(
+            f"{index.freqs[bin_] / 1e6:>10.3f} MHz {x_pos:>8.2f} {y_pos:>8.2f} "
+            f"{level:>6.1f} {units:<3} {prominence:>11.1f}"
+        )
+    return "\n".join(lines)
+
+
+def build(args) -> None:
+    for path in (args.PATH, args.remove_background):
+        if path is not None and not (os.path.isdir(path) or is_scan_file(path)):
+            print(f"Path doesn't exist {path}")
+            sys.exit()
+    cache = None if args.no_cache else StageCache(args.cache_dir)
+    started = time.perf_counter()
+    try:
+        scan = select_trace(load_scan(args.PATH, args.workers, cache), args.trace)
+    except (KeyError, ValueError) as e:
+        print(e.args[0])
+        sys.exit()
+    background = None
+    if args.remove_background is not None:
+        background = load_background(
+            args.remove_background, scan, "auto", cache, args.workers, args.trace
+        )
+    peaks = extract_peaks(
+        scan, args.threshold, args.prominence, background, args.window
+    )
+    metadata = {
+        "source": os.path.abspath(args.PATH),
+        "background": args.remove_background,
+        "trace": args.trace or scan.metadata.get("detector"),
+        "units": scan.metadata.get("units"),
+        "threshold": args.threshold,
+        "prominence": args.prominence,
+        "window": args.window,
+        "points": int(scan.mask.sum()),
+    }
+    index = build_index(peaks, scan.freqs, metadata)
+    output = args.output or default_index_path(args.PATH)
+    index.save(output)
+    print(
+        f"Indexed {len(index)} peaks of {metadata['points']} points in "
+        f"{time.perf_counter() - started:.2f} s into {output}"
+    )
+
+
+def query(args) -> None:
+    if not os.path.isfile(args.INDEX):
+        print(f"Index doesn't exist {args.INDEX}")
+        sys.exit()
+    started = time.perf_counter()
+    index = PeakIndex.load(args.INDEX)
+    if args.frequency is not None:
+        entries = index.spot(args.frequency, args.tolerance, args.top)
+    elif args.band is not None:
+        entries = index.band(*args.band, args.top)
+    else:
+        entries = index.top(args.top or 10)
+    elapsed = time.perf_counter() - started
+    print(format_entries(index, entries))
+    print(f"{len(entries['bin'])} entries in {elapsed * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="emi peak index",
+        description="Extract the emission peaks of a measurement into an index and query where on the board a frequency is strongest.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser(
+        "build", help="Extract the peaks of a measurement into an index"
+    )
+    build_parser.add_argument(
+        "PATH", type=str, help="Path to measurement files or to a scan file"
+    )
+    build_parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help=f"Path of the index. Default is {INDEX_NAME} in the measurement directory or next to the scan file",
+    )
+    build_parser.add_argument(
+        "-b",
+        "--remove-background",
+        type=str,
+        help="Measure the peak threshold from this background measurement instead of every point's median level",
+    )
+    build_parser.add_argument(
+        "--threshold",
+        type=float,
+        help="Minimum level in dB of a peak above the floor. Default is 6",
+        default=6.0,
+    )
+    build_parser.add_argument(
+        "--prominence",
+        type=float,
+        help="Minimum level in dB of a peak above the lowest levels around it. Default is 3",
+        default=3.0,
+    )
+    build_parser.add_argument(
+        "--window",
+        type=int,
+        help=f"Bins on each side of a peak its prominence is measured over. Default is {PROMINENCE_WINDOW}",
+        default=PROMINENCE_WINDOW,
+    )
+    build_parser.add_argument(
+        "-t",
+        "--trace",
+        type=str,
+        help="Index this trace of a scan captured with several detectors. Default is the first trace",
+    )
+    build_parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help=f"Directory for precomputed processing artifacts. Default is {DEFAULT_CACHE_DIR}",
+        default=DEFAULT_CACHE_DIR,
+    )
+    build_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write precomputed processing artifacts",
+    )
+    build_parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help="Number of processes parsing CSV measurement files. Default is the number of CPUs",
+    )
+    build_parser.set_defaults(run=build)
+    query_parser = commands.add_parser(
+        "query", help="Find the locations where frequencies peak the strongest"
+    )
+    query_parser.add_argument("INDEX", type=str, help="Path to a peak index")
+    target = query_parser.add_mutually_exclusive_group()
+    target.add_argument(
+        "-f",
+        "--frequency",
+        type=float,
+        help="Rank the locations where this frequency in Hz peaks",
+    )
+    target.add_argument(
+        "--band",
+        type=float,
+        nargs=2,
+        help="Rank the locations by their strongest peak between two frequencies in Hz",
+    )
+    query_parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="Frequency distance in Hz of the peaks counted for --frequency. Default is one bin",
+    )
+    query_parser.add_argument(
+        "-n",
+        "--top",
+        type=int,
+        help="Show only this many entries. Without --frequency or --band the strongest frequencies are listed, 10 by default",
+    )
+    query_parser.set_defaults(run=query)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
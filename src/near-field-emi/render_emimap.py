@@ -1,57 +1,88 @@
 import bpy
-import bmesh
 import numpy as np
-from os import listdir
 from os.path import isfile, join
 from os import getcwd
 import argparse
+import json
+import os
 import sys
 
+# Blender doesn't put the script's directory on the path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from render_jobs import (
+    DEFAULT_QUALITY,
+    DEFAULT_TRIANGLES,
+    QUALITY_PRESETS,
+    list_heatmaps,
+    pending_jobs,
+    read_jobs,
+    remove_incomplete_frames,
+    render_output,
+    sweep_order,
+    sweep_output,
+)
 
-def get_subdivision(obj):
-    for i, mat_slot in enumerate(obj.material_slots):
-        bpy.context.object.active_material_index = i
-        bpy.ops.object.mode_set(mode="EDIT")
-        bpy.ops.mesh.select_all(action="DESELECT")
-        bpy.ops.object.material_slot_select()
-        me = bpy.context.object.data
-        bm = bmesh.from_edit_mesh(me)
-        edge_lengths = []
-        for e in bm.edges:
-            e.select_set(True)
-            if e.select:
-                edge_lengths.append(int(e.calc_length()))
-            e.select_set(False)
-        short = min(edge_lengths)
-        long = max(edge_lengths)
-        long_edges = [edge for edge in bm.edges if int(edge.calc_length()) == long]
-        bm.edges.ensure_lookup_table()
-        bmesh.ops.subdivide_edges(bm, edges=long_edges, cuts=long)
-        bmesh.update_edit_mesh(me)
-        bm.edges.ensure_lookup_table()
-        short_edges = [edge for edge in bm.edges if int(edge.calc_length()) == short]
-        bmesh.ops.subdivide_edges(bm, edges=short_edges, cuts=short)
-        bmesh.update_edit_mesh(me)
-    bpy.ops.object.mode_set(mode="OBJECT")
-
-
-def load_texture(material, path, freq):
-    nodes = material.node_tree.nodes
-    imgs = [i.filepath for i in bpy.data.images]
-    color = path + "color/" + freq
-    grey = path + "grey/" + freq[:-4] + "_grey.png"
-    if grey not in imgs:
-        map_grey = bpy.data.images.load(filepath=grey)
-    else:
-        idx = imgs.index(grey)
-        map_grey = bpy.data.images[idx]
-    if color not in imgs:
-        map_color = bpy.data.images.load(filepath=color)
+HEIGHTMAP_METADATA = "height/heightmap.json"
+
+
+def read_heightmap_metadata(path):
+    # heightmaps are written by data_process.py unless it saved grey PNGs
+    metadata = join(path, HEIGHTMAP_METADATA)
+    if not isfile(metadata):
+        return None
+    with open(metadata) as f:
+        return json.load(f)
+
+
+def load_image(images, filepath):
+    # images are looked up by path in the cache instead of in bpy.data
+    image = images.get(filepath)
+    if image is None:
+        image = bpy.data.images.load(filepath=filepath, check_existing=True)
+        images[filepath] = image
+    return image
+
+
+def load_heightmap(images, path, freq, heightmap):
+    # heightmaps hold the field scaled into 0-1 and are used as they are, so
+    # they're loaded as non-color data; NumPy arrays are copied into a float
+    # image once, later frames reuse the image
+    height = path + "height/" + freq[:-4] + heightmap["extension"]
+    if heightmap["format"] == "npy":
+        image = images.get(height) or bpy.data.images.get(height)
+        if image is None:
+            values = np.load(height)
+            rows, cols = values.shape
+            image = bpy.data.images.new(
+                height, cols, rows, float_buffer=True, is_data=True
+            )
+            pixels = np.ones((rows, cols, 4), dtype=np.float32)
+            # Blender images start with the bottom row
+            pixels[:, :, :3] = values[::-1, :, None]
+            image.pixels.foreach_set(pixels.ravel())
+        images[height] = image
     else:
-        idx = imgs.index(color)
-        map_color = bpy.data.images[idx]
-    nodes["Texture Color"].image = map_color
-    nodes["Texture Grey"].image = map_grey
+        image = load_image(images, height)
+    image.colorspace_settings.name = "Non-Color"
+    return image
+
+
+def load_textures(path, bands, heightmap=None):
+    # (color, grey) images of every band, loaded once before rendering
+    images = {image.filepath: image for image in bpy.data.images}
+    textures = {}
+    for freq in bands:
+        if heightmap is not None:
+            map_grey = load_heightmap(images, path, freq, heightmap)
+        else:
+            map_grey = load_image(images, path + "grey/" + freq[:-4] + "_grey.png")
+        textures[freq] = (load_image(images, path + "color/" + freq), map_grey)
+    return textures
+
+
+def bind_texture(material, texture):
+    nodes = material.node_tree.nodes
+    nodes["Texture Color"].image, nodes["Texture Grey"].image = texture
 
 
 def prep_material(path, name):
@@ -70,36 +101,86 @@ def prep_material(path, name):
     return emi_mat
 
 
-def prep_plane(material):
-    is_plane = False
-    emi_plane = ""
-    board_size = bpy.data.objects["PCB_layer1"].dimensions
-    board_loc = bpy.data.objects["PCB_layer1"].location
+def field_resolution(path, heatmap_name, heightmap):
+    # pixels of the heightmaps along x and y, data_process.py saves them in
+    # the metadata, grey PNGs are opened to read their size
+    if heightmap is not None:
+        return heightmap["size"]
+    grey = path + "grey/" + heatmap_name[:-4] + "_grey.png"
+    return list(bpy.data.images.load(filepath=grey, check_existing=True).size)
 
-    heatmap_loc = board_loc.copy()
+
+def grid_segments(resolution, max_triangles=DEFAULT_TRIANGLES):
+    # a vertex per pixel, both axes scaled down evenly to fit the budget
+    segments = [max(1, pixels - 1) for pixels in resolution]
+    scale = min(1.0, np.sqrt(max_triangles / (2 * segments[0] * segments[1])))
+    return [max(1, int(count * scale)) for count in segments]
+
+
+def grid_mesh(name, size, segments):
+    # a plane of size[0] by size[1] centred on the origin, with UVs spanning
+    # the whole heatmap like the default plane's
+    count_x, count_y = segments
+    u, v = np.meshgrid(
+        np.linspace(0, 1, count_x + 1), np.linspace(0, 1, count_y + 1), indexing="ij"
+    )
+    vertices = np.zeros((u.size, 3))
+    vertices[:, 0] = (u.ravel() - 0.5) * size[0]
+    vertices[:, 1] = (v.ravel() - 0.5) * size[1]
+    corners = np.arange(u.size).reshape(u.shape)[:-1, :-1].ravel()
+    rows = count_y + 1
+    faces = np.stack([corners, corners + rows, corners + rows + 1, corners + 1], axis=1)
+    mesh = bpy.data.meshes.new(name)
+    mesh.from_pydata(vertices.tolist(), [], faces.tolist())
+    uv_layer = mesh.uv_layers.new(name="UVMap")
+    uv = np.stack([u.ravel(), v.ravel()], axis=1)
+    uv_layer.data.foreach_set("uv", uv[faces.ravel()].astype(np.float32).ravel())
+    mesh.update()
+    return mesh
+
+
+def prep_plane(material, segments):
+    # the plane is kept in the .blend with the grid it was built with, a
+    # saved plane of the same grid is reused as it is
+    board = bpy.data.objects["PCB_layer1"]
+    emi_plane = bpy.data.objects.get("Field")
+    if emi_plane is not None and list(emi_plane.get("emi_grid", [])) == segments:
+        return emi_plane, False
+    heatmap_loc = board.location.copy()
     heatmap_loc[2] = heatmap_loc[1] + 10
-    for b in bpy.data.objects:
-        if b.name == "Field":
-            is_plane = True
-            emi_plane = b
-    if not is_plane:
-        bpy.ops.mesh.primitive_plane_add(size=1.0, location=heatmap_loc)
-        bpy.context.active_object.name = "Field"
-        emi_plane = bpy.data.objects["Field"]
-        emi_plane.select_set(True)
-        bpy.ops.transform.resize(value=board_size)
-        bpy.ops.object.transform_apply(scale=True)
-        emi_plane.data.materials.append(material)
-        get_subdivision(emi_plane)
-    return emi_plane
-
-
-def render_settings(view):
-    bpy.context.scene.render.engine = "CYCLES"
-    bpy.context.scene.cycles.feature_set = "SUPPORTED"
-    bpy.context.scene.render.image_settings.file_format = "PNG"
-    bpy.context.scene.render.resolution_x = 880
-    bpy.context.scene.render.resolution_y = 800
+    mesh = grid_mesh("Field", board.dimensions, segments)
+    mesh.materials.append(material)
+    if emi_plane is None:
+        emi_plane = bpy.data.objects.new("Field", mesh)
+        bpy.context.scene.collection.objects.link(emi_plane)
+        emi_plane.location = heatmap_loc
+    else:
+        old_mesh = emi_plane.data
+        emi_plane.data = mesh
+        bpy.data.meshes.remove(old_mesh)
+    emi_plane["emi_grid"] = segments
+    print(f"Field plane built with {2 * segments[0] * segments[1]} triangles")
+    return emi_plane, True
+
+
+def render_settings(quality=DEFAULT_QUALITY):
+    scene = bpy.context.scene
+    scene.render.engine = "CYCLES"
+    scene.cycles.feature_set = "SUPPORTED"
+    scene.render.image_settings.file_format = "PNG"
+    scene.render.resolution_x = 880
+    scene.render.resolution_y = 800
+    preset = QUALITY_PRESETS[quality]
+    scene.render.resolution_percentage = preset["resolution_percentage"]
+    if preset["samples"] is not None:
+        scene.cycles.samples = preset["samples"]
+    if preset["denoise"] is not None:
+        scene.cycles.use_denoising = preset["denoise"]
+    # keeps the scene synced between frames, only the textures change
+    scene.render.use_persistent_data = preset["persistent_data"]
+
+
+def select_camera(view):
     for cam in bpy.data.cameras:
         if view in cam.name:
             bpy.context.scene.camera = bpy.data.objects[cam.name]
@@ -108,6 +189,50 @@ def render_settings(view):
             bpy.context.scene.camera = bpy.data.objects["camera_photo"]
 
 
+def render_frame(path):
+    # rendered once and written under a temporary name, a frame which exists
+    # is always complete and an interrupted batch resumes after it
+    partial = path[:-4] + ".part.png"
+    bpy.context.scene.render.filepath = partial
+    bpy.ops.render.render(write_still=True)
+    os.replace(partial, path)
+
+
+def render_sweep(material, textures, bands, output, video, fps):
+    # a frame per band in frequency order, the textures are swapped when the
+    # frame changes so the whole sweep renders as one animation
+    scene = bpy.context.scene
+    scene.frame_start = 1
+    scene.frame_end = len(bands)
+    scene.render.fps = fps
+    scene.render.fps_base = 1
+    if video:
+        # encoded under a temporary name, an existing video is complete
+        scene.render.filepath = output[:-4] + ".part.mp4"
+        scene.render.image_settings.file_format = "FFMPEG"
+        scene.render.ffmpeg.format = "MPEG4"
+        scene.render.ffmpeg.codec = "H264"
+        scene.render.ffmpeg.constant_rate_factor = "HIGH"
+    else:
+        # complete frames of an interrupted sweep are kept, the one it was
+        # writing is removed before resuming
+        scene.render.filepath = output
+        scene.render.image_settings.file_format = "PNG"
+        scene.render.use_overwrite = False
+
+    def swap_texture(scene, *args):
+        frame = min(max(scene.frame_current, 1), len(bands))
+        bind_texture(material, textures[bands[frame - 1]])
+
+    bpy.app.handlers.frame_change_pre.append(swap_texture)
+    try:
+        bpy.ops.render.render(animation=True)
+    finally:
+        bpy.app.handlers.frame_change_pre.remove(swap_texture)
+    if video:
+        os.replace(scene.render.frame_path(), output)
+
+
 def main():
     if "--" in sys.argv:
         argv = sys.argv[sys.argv.index("--") + 1 :]
@@ -134,7 +259,50 @@ def main():
             help="Path to save renders",
             default=getcwd(),
         )
+        parser.add_argument(
+            "-q",
+            "--quality",
+            type=str,
+            choices=list(QUALITY_PRESETS),
+            help=f"Quality preset setting the samples, resolution, denoising and persistent data of the renders. Default is {DEFAULT_QUALITY}",
+            default=DEFAULT_QUALITY,
+        )
+        parser.add_argument(
+            "--jobs",
+            type=str,
+            help="JSON file with the [camera, heatmap] pairs to render, written by render_farm.py. Default is every camera with every heatmap",
+        )
+        parser.add_argument(
+            "--max_triangles",
+            type=int,
+            help=f"Triangles of the field plane at most, it gets a vertex per heatmap pixel within this budget. Default is {DEFAULT_TRIANGLES}",
+            default=DEFAULT_TRIANGLES,
+        )
+        parser.add_argument(
+            "--save_plane",
+            action="store_true",
+            help="Save the field plane into the .blend file after building it, so later runs reuse it. Default is False",
+        )
+        parser.add_argument(
+            "--animate",
+            action="store_true",
+            help="Render every camera's frequency sweep as one animation, a frame per band. Default is False",
+        )
+        parser.add_argument(
+            "--video",
+            action="store_true",
+            help="Encode the sweep animations to MP4 videos instead of numbered PNG frames. Default is False",
+        )
+        parser.add_argument(
+            "--fps",
+            type=int,
+            help="Bands shown per second in the sweep animations. Default is 2",
+            default=2,
+        )
         args = parser.parse_known_args(argv)[0]
+    else:
+        print("Pass the script's arguments after --")
+        sys.exit()
 
     # asset material for EMI map shader
     map_mat_path = getcwd() + "/assets/emi_material.blend"
@@ -144,21 +312,63 @@ def main():
     rpath = args.render_path
     views = args.camera
 
+    # renders which already exist are skipped
+    if args.animate:
+        bands = sweep_order(list_heatmaps(heatmaps))
+        video = args.video
+        sweeps = [
+            view
+            for view in views
+            if not (video and isfile(sweep_output(rpath, view, video)))
+        ]
+        if not sweeps:
+            print("Every sweep video already exists in", rpath)
+            return
+    else:
+        if args.jobs is not None:
+            jobs = read_jobs(args.jobs)
+        else:
+            jobs = pending_jobs(views, list_heatmaps(heatmaps), rpath)
+        jobs = [job for job in jobs if not isfile(render_output(rpath, *job))]
+        if not jobs:
+            print("Every render already exists in", rpath)
+            return
+        bands = list(dict.fromkeys(heatmap_name for _, heatmap_name in jobs))
+
     # prepare scene with emi map
     hfield = prep_material(map_mat_path, "emi_map")
-    prep_plane(hfield)
-    cc = heatmaps + "color"
-    maps = [f for f in listdir(cc) if isfile(join(cc, f))]
-    load_texture(hfield, heatmaps, maps[2])
-    # render
-    for j in views:
-        render_settings(j)
-        for i in range(0, len(maps)):
-            load_texture(hfield, heatmaps, maps[i])
-            bpy.context.scene.render.filepath = rpath + "/" + j + "_" + maps[i]
-            bpy.ops.render.render()
-            print("Saving render: ", rpath + "/" + j + "_" + maps[i])
-            bpy.ops.render.render(use_viewport=True, write_still=True)
+    heightmap = read_heightmap_metadata(heatmaps)
+    segments = grid_segments(
+        field_resolution(heatmaps, bands[0], heightmap), args.max_triangles
+    )
+    _, built = prep_plane(hfield, segments)
+    if built and args.save_plane:
+        # later runs find the plane in the .blend and skip building it
+        bpy.ops.wm.save_mainfile()
+    render_settings(args.quality)
+    textures = load_textures(heatmaps, bands, heightmap)
+
+    if args.animate:
+        for n, view in enumerate(sweeps):
+            select_camera(view)
+            output = sweep_output(rpath, view, video)
+            if not video:
+                for frame in remove_incomplete_frames(rpath, view):
+                    print("Removed incomplete frame", frame)
+            print(f"Rendering sweep {n + 1}/{len(sweeps)}: {output}")
+            render_sweep(hfield, textures, bands, output, video, args.fps)
+        return
+
+    # render, the textures are only bound when the band changes
+    bound = None
+    for n, (view, heatmap_name) in enumerate(jobs):
+        if heatmap_name != bound:
+            bind_texture(hfield, textures[heatmap_name])
+            bound = heatmap_name
+        select_camera(view)
+        output = render_output(rpath, view, heatmap_name)
+        print(f"Rendering {n + 1}/{len(jobs)}: {output}")
+        render_frame(output)
 
 
 if __name__ == "__main__":
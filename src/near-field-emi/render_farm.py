@@ -0,0 +1,160 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from render_jobs import (
+    DEFAULT_QUALITY,
+    DEFAULT_TRIANGLES,
+    QUALITY_PRESETS,
+    list_heatmaps,
+    pending_jobs,
+    split_jobs,
+    write_jobs,
+)
+
+RENDER_SCRIPT = Path(__file__).resolve().parent / "render_emimap.py"
+
+# Splits the renders of every camera with every heatmap between headless
+# Blender processes running render_emimap.py, each given its share of the jobs
+# in a JSON file. Renders which already exist are skipped when the jobs are
+# handed out and again by the workers, so rerunning an interrupted batch only
+# renders what's missing.
+
+
+def worker_command(args, jobs_path: str) -> list:
+    command = [args.blender, args.blend, "-b"]
+    if args.threads is not None:
+        command += ["-t", str(args.threads)]
+    # Blender exits with 0 after an exception in the script unless told not to
+    return command + [
+        "--python-exit-code",
+        "1",
+        "-P",
+        str(RENDER_SCRIPT),
+        "--",
+        args.heatmap_path,
+        "--render_path",
+        args.render_path,
+        "--quality",
+        args.quality,
+        "--jobs",
+        jobs_path,
+        "--max_triangles",
+        str(args.max_triangles),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="emi render farm",
+        description="Render the 3D maps of every camera and heatmap in parallel Blender processes, resuming an interrupted batch.",
+    )
+    parser.add_argument("blend", type=str, help="Path to the DUT .blend model")
+    parser.add_argument(
+        "heatmap_path",
+        type=str,
+        help="Path to heatmaps generated in previous stages",
+    )
+    parser.add_argument(
+        "-c",
+        "--camera",
+        nargs="+",
+        help="Choose a list of camera names available in board blend. Default is Camera",
+        default=["Camera"],
+    )
+    parser.add_argument(
+        "-rp",
+        "--render_path",
+        type=str,
+        help="Path to save renders",
+        default=os.getcwd(),
+    )
+    parser.add_argument(
+        "-q",
+        "--quality",
+        type=str,
+        choices=list(QUALITY_PRESETS),
+        help=f"Quality preset of the renders. Default is {DEFAULT_QUALITY}",
+        default=DEFAULT_QUALITY,
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help="Number of Blender processes. Default is 2",
+        default=2,
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        help="Render threads of every Blender process. Default is Blender's, all CPUs",
+    )
+    parser.add_argument(
+        "--max_triangles",
+        type=int,
+        help=f"Triangles of the field plane at most. Default is {DEFAULT_TRIANGLES}",
+        default=DEFAULT_TRIANGLES,
+    )
+    parser.add_argument(
+        "--blender",
+        type=str,
+        help="Blender executable. Default is blender",
+        default="blender",
+    )
+    args = parser.parse_args()
+    # render_emimap.py builds the texture paths by appending to this one
+    args.heatmap_path = os.path.join(args.heatmap_path, "")
+    if not os.path.isdir(os.path.join(args.heatmap_path, "color")):
+        print(f"No heatmaps found in {args.heatmap_path}")
+        sys.exit()
+    os.makedirs(args.render_path, exist_ok=True)
+
+    heatmaps = list_heatmaps(args.heatmap_path)
+    jobs = pending_jobs(args.camera, heatmaps, args.render_path)
+    total = len(args.camera) * len(heatmaps)
+    if not jobs:
+        print(f"All {total} renders already exist in {args.render_path}")
+        return
+    shares = split_jobs(jobs, args.workers)
+    print(
+        f"Rendering {len(jobs)} of {total} frames with {len(shares)} Blender processes"
+    )
+    started = time.monotonic()
+    with tempfile.TemporaryDirectory(prefix="emi-render-") as jobs_dir:
+        workers = []
+        for n, share in enumerate(shares):
+            jobs_path = os.path.join(jobs_dir, f"jobs_{n}.json")
+            write_jobs(jobs_path, share)
+            log_path = os.path.join(args.render_path, f"render_worker_{n}.log")
+            log = open(log_path, "w")
+            process = subprocess.Popen(
+                worker_command(args, jobs_path),
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+            workers.append((process, log, log_path, len(share)))
+        failed = 0
+        for process, log, log_path, count in workers:
+            process.wait()
+            log.close()
+            if process.returncode != 0:
+                failed += 1
+                print(
+                    f"Blender process failed rendering {count} frames, see {log_path}"
+                )
+    missing = len(pending_jobs(args.camera, heatmaps, args.render_path))
+    print(
+        f"Rendered {len(jobs) - missing} frames in {time.monotonic() - started:.0f} s"
+        + (f", {missing} missing, rerun to resume" if missing else "")
+    )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import glob
+import json
+import os
+import re
+
+# Shared by render_emimap.py, which runs inside Blender, and render_farm.py,
+# which runs with the system Python and starts the Blender workers, so this
+# module must not import bpy.
+
+# Cycles settings of the named quality presets, None keeps the setting saved
+# in the board's .blend file
+QUALITY_PRESETS = {
+    "preview": {
+        "samples": 16,
+        "resolution_percentage": 50,
+        "denoise": True,
+        "persistent_data": True,
+    },
+    "standard": {
+        "samples": None,
+        "resolution_percentage": 100,
+        "denoise": None,
+        "persistent_data": True,
+    },
+    "publication": {
+        "samples": 1024,
+        "resolution_percentage": 200,
+        "denoise": True,
+        "persistent_data": True,
+    },
+}
+DEFAULT_QUALITY = "standard"
+# triangles of the field plane, a vertex per heatmap pixel up to this many
+DEFAULT_TRIANGLES = 200000
+# heatmaps are named after their band, like "30.0 MHz - 100.0 MHz.png"
+BAND_START = re.compile(r"([0-9.]+) ?(Hz|kHz|MHz|GHz)")
+UNITS = {"Hz": 1, "kHz": 1e3, "MHz": 1e6, "GHz": 1e9}
+# every complete PNG ends with the IEND chunk, its length and its CRC
+PNG_END = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+
+
+def list_heatmaps(heatmap_path: str) -> list:
+    color = os.path.join(heatmap_path, "color")
+    return sorted(
+        f for f in os.listdir(color) if os.path.isfile(os.path.join(color, f))
+    )
+
+
+def sweep_order(heatmaps: list) -> list:
+    # heatmaps by the start of their band, those not named after a band last
+    def start(heatmap):
+        match = BAND_START.match(heatmap)
+        if match is None:
+            return float("inf"), heatmap
+        return float(match[1]) * UNITS[match[2]], heatmap
+
+    return sorted(heatmaps, key=start)
+
+
+def sweep_output(render_path: str, camera: str, video: bool) -> str:
+    # a video, or the pattern of the numbered frames Blender writes
+    return os.path.join(render_path, camera + ("_sweep.mp4" if video else "_sweep_"))
+
+
+def is_complete_png(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < len(PNG_END):
+            return False
+        f.seek(-len(PNG_END), os.SEEK_END)
+        return f.read() == PNG_END
+
+
+def remove_incomplete_frames(render_path: str, camera: str) -> list:
+    # frames of a sweep cut short while being written, so they're rendered
+    # again instead of being skipped as existing
+    pattern = sweep_output(render_path, camera, False) + "[0-9]" * 4 + ".png"
+    removed = [path for path in glob.glob(pattern) if not is_complete_png(path)]
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def render_output(render_path: str, camera: str, heatmap: str) -> str:
+    return os.path.join(render_path, camera + "_" + heatmap)
+
+
+def pending_jobs(cameras: list, heatmaps: list, render_path: str) -> list:
+    # (camera, heatmap) of the renders which don't exist yet, band by band so
+    # a band's textures are loaded once for all the cameras
+    return [
+        (camera, heatmap)
+        for heatmap in heatmaps
+        for camera in cameras
+        if not os.path.exists(render_output(render_path, camera, heatmap))
+    ]
+
+
+def split_jobs(jobs: list, workers: int) -> list:
+    # whole bands are handed out in turns, every worker loads only its bands
+    bands = {}
+    for camera, heatmap in jobs:
+        bands.setdefault(heatmap, []).append((camera, heatmap))
+    shares = [[] for _ in range(workers)]
+    for n, band_jobs in enumerate(bands.values()):
+        shares[n % workers].extend(band_jobs)
+    return [share for share in shares if share]
+
+
+def write_jobs(path: str, jobs: list) -> None:
+    with open(path, "w") as f:
+        json.dump(jobs, f)
+
+
+def read_jobs(path: str) -> list:
+    with open(path) as f:
+        return [tuple(job) for job in json.load(f)]
@@ -0,0 +1,218 @@
+from typing import Optional
+
+import numpy as np
+
+from scan_file import Scan, is_scan_file, open_scan, read_csv_dir, source_fingerprint
+from stage_cache import StageCache, cached_scan, stage_key
+
+# coordinates closer than this, in mm, are treated as the same probe position
+COORDINATE_TOLERANCE = 1e-3
+# values read by chunks() at a time
+CHUNK_SIZE = 1 << 23
+
+# A ScanDataset is a view of a scan narrowed down to a region of the board, a
+# frequency range and a trace. Narrowing only slices the axes, nothing is
+# read until read(), point() or chunks() is called, and scan files are memory
+# mapped, so only the pages of the selected slice are ever read from disk.
+# Traces may also be the difference of two, like POS-RMS, which is computed
+# from the two slices when read.
+
+
+def load_scan(
+    path: str, workers: Optional[int] = None, cache: Optional[StageCache] = None
+) -> Scan:
+    # scan files are memory mapped as they are, CSV directories are parsed
+    # into the cache once
+    if is_scan_file(path):
+        return open_scan(path)
+    return cached_scan(
+        cache,
+        "scan",
+        stage_key(source_fingerprint(path)),
+        lambda: read_csv_dir(path, workers),
+    )
+
+
+def open_dataset(
+    path: str, workers: Optional[int] = None, cache: Optional[StageCache] = None
+) -> "ScanDataset":
+    return ScanDataset(load_scan(path, workers, cache))
+
+
+def as_dataset(measurement) -> "ScanDataset":
+    if isinstance(measurement, ScanDataset):
+        return measurement
+    return ScanDataset(measurement)
+
+
+def axis_slice(axis: np.ndarray, low: Optional[float], high: Optional[float]):
+    # indices of the values between low and high, both included
+    first = 0 if low is None else np.searchsorted(axis, low, side="left")
+    last = len(axis) if high is None else np.searchsorted(axis, high, side="right")
+    return slice(int(first), int(max(first, last)))
+
+
+def narrow(current: slice, inner: slice) -> slice:
+    # a slice relative to the current one, in indices of the whole axis
+    return slice(current.start + inner.start, current.start + inner.stop)
+
+
+class ScanDataset:
+    def __init__(
+        self,
+        scan: Scan,
+        x_slice: Optional[slice] = None,
+        y_slice: Optional[slice] = None,
+        f_slice: Optional[slice] = None,
+        trace: Optional[str] = None,
+    ):
+        self.scan = scan
+        self.x_slice = x_slice or slice(0, len(scan.x))
+        self.y_slice = y_slice or slice(0, len(scan.y))
+        self.f_slice = f_slice or slice(0, len(scan.freqs))
+        self.trace_name = trace
+        # (sign, array) of the traces added up when reading
+        if trace is None:
+            self.terms = [(1, scan.data)]
+        else:
+            names = trace.split("-")
+            if len(names) > 2:
+                raise ValueError(
+                    f"Trace {trace} isn't a trace name or a difference of two"
+                )
+            self.terms = [
+                (sign, scan.trace(name)) for sign, name in zip((1, -1), names)
+            ]
+
+    def _replace(self, **changes) -> "ScanDataset":
+        parameters = {
+            "x_slice": self.x_slice,
+            "y_slice": self.y_slice,
+            "f_slice": self.f_slice,
+            "trace": self.trace_name,
+        }
+        parameters.update(changes)
+        return ScanDataset(self.scan, **parameters)
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.scan.x[self.x_slice]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.scan.y[self.y_slice]
+
+    @property
+    def freqs(self) -> np.ndarray:
+        return np.asarray(self.scan.freqs[self.f_slice])
+
+    @property
+    def mask(self) -> np.ndarray:
+        return np.asarray(self.scan.mask[self.x_slice, self.y_slice])
+
+    @property
+    def shape(self) -> tuple:
+        return len(self.x), len(self.y), len(self.freqs)
+
+    @property
+    def traces(self) -> list:
+        return self.scan.traces or [self.scan.metadata.get("detector")]
+
+    @property
+    def metadata(self) -> dict:
+        return self.scan.metadata
+
+    def region(
+        self, x: Optional[tuple] = None, y: Optional[tuple] = None
+    ) -> "ScanDataset":
+        # the points within the x and y ranges in mm, edges included
+        changes = {}
+        for name, bounds, axis, current in (
+            ("x_slice", x, self.x, self.x_slice),
+            ("y_slice", y, self.y, self.y_slice),
+        ):
+            if bounds is not None:
+                low, high = bounds
+                inner = axis_slice(
+                    axis,
+                    None if low is None else low - COORDINATE_TOLERANCE,
+                    None if high is None else high + COORDINATE_TOLERANCE,
+                )
+                changes[name] = narrow(current, inner)
+        return self._replace(**changes)
+
+    def frequencies(
+        self, low: Optional[float] = None, high: Optional[float] = None
+    ) -> "ScanDataset":
+        inner = axis_slice(self.freqs, low, high)
+        return self._replace(f_slice=narrow(self.f_slice, inner))
+
+    def trace(self, name: str) -> "ScanDataset":
+        return self._replace(trace=name)
+
+    def sel(
+        self,
+        x: Optional[tuple] = None,
+        y: Optional[tuple] = None,
+        freq: Optional[tuple] = None,
+        trace: Optional[str] = None,
+    ) -> "ScanDataset":
+        dataset = self.region(x, y)
+        if freq is not None:
+            dataset = dataset.frequencies(*freq)
+        return dataset if trace is None else dataset.trace(trace)
+
+    def _read(self, x_slice: slice, y_slice, f_slice) -> np.ndarray:
+        sign, array = self.terms[0]
+        values = np.array(array[x_slice, y_slice, f_slice], dtype=np.float32)
+        for sign, array in self.terms[1:]:
+            values += sign * np.asarray(array[x_slice, y_slice, f_slice])
+        return values
+
+    def read(self) -> np.ndarray:
+        return self._read(self.x_slice, self.y_slice, self.f_slice)
+
+    def point(self, x_pos: float, y_pos: float) -> np.ndarray:
+        i, j = self.scan.index_of(x_pos, y_pos)
+        return self._read(i, j, self.f_slice)
+
+    def chunks(self, chunk_size: int = CHUNK_SIZE):
+        # (row offset, values) of consecutive rows of points, a chunk holds
+        # about chunk_size values
+        count_x, count_y, count_f = self.shape
+        rows = max(1, chunk_size // max(1, count_y * count_f))
+        for start in range(0, count_x, rows):
+            x_slice = slice(
+                self.x_slice.start + start,
+                min(self.x_slice.start + start + rows, self.x_slice.stop),
+            )
+            yield start, self._read(x_slice, self.y_slice, self.f_slice)
+
+    def captured_axes(self) -> tuple:
+        # coordinates of the rows and columns holding at least one point
+        mask = self.mask.astype(bool)
+        return self.x[mask.any(axis=1)], self.y[mask.any(axis=0)]
+
+    def to_scan(self) -> Scan:
+        # a scan of the selection, plain traces stay memory mapped views
+        if len(self.terms) == 1:
+            data = self.terms[0][1][self.x_slice, self.y_slice, self.f_slice]
+        else:
+            data = self.read()
+        arrays = {"freqs": self.freqs, "mask": self.mask, "data": data}
+        metadata = {
+            key: value for key, value in self.scan.metadata.items() if key != "traces"
+        }
+        if self.trace_name is not None:
+            metadata["detector"] = self.trace_name
+        return Scan(self.x, self.y, arrays, metadata)
+
+    def __repr__(self) -> str:
+        x, y, freqs = self.x, self.y, self.freqs
+        parts = [f"{len(x)}x{len(y)} points"]
+        if len(x) and len(y):
+            parts.append(f"x {x[0]:g}-{x[-1]:g} mm, y {y[0]:g}-{y[-1]:g} mm")
+        if len(freqs):
+            parts.append(f"{len(freqs)} frequencies {freqs[0]:g}-{freqs[-1]:g} Hz")
+        parts.append(f"trace {self.trace_name or self.traces[0]}")
+        return f"ScanDataset({', '.join(parts)})"
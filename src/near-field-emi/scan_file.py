@@ -0,0 +1,408 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+# Layout of a scan file:
+#   8 bytes   magic
+#   4 bytes   little-endian length of the JSON header
+#   JSON header (grid axes, metadata, array table), zero padded to ALIGNMENT
+#   arrays listed in the header, each starting on an ALIGNMENT boundary
+# The arrays are plain C-ordered buffers, so they can be memory mapped directly.
+MAGIC = b"EMISCAN\x00"
+VERSION = 1
+ALIGNMENT = 4096
+SCAN_SUFFIX = ".emiscan"
+
+POINT_NAME = re.compile(r"^x(-?[0-9.]+)_y(-?[0-9.]+)\.csv$")
+# scans of several SA traces keep the first one in "data" and the others in
+# "data_<name>" arrays, the names are listed in the "traces" metadata
+TRACE_PREFIX = "data_"
+
+
+def _align(value: int) -> int:
+    return -(-value // ALIGNMENT) * ALIGNMENT
+
+
+def point_file_name(x_pos: float, y_pos: float) -> str:
+    return f"x{x_pos}_y{y_pos}.csv"
+
+
+def parse_point_name(file_name: str) -> Optional[tuple]:
+    match = POINT_NAME.match(file_name)
+    if match is None:
+        return None
+    return float(match.group(1)), float(match.group(2))
+
+
+def trace_array_name(traces: list, name: str) -> str:
+    return "data" if not traces or name == traces[0] else TRACE_PREFIX + name
+
+
+def is_scan_file(path: str) -> bool:
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class Scan:
+    def __init__(self, x, y, arrays: dict, metadata: Optional[dict] = None):
+        self.metadata = metadata if metadata is not None else {}
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.arrays = arrays
+        self._x_index = {float(v): i for i, v in enumerate(self.x)}
+        self._y_index = {float(v): i for i, v in enumerate(self.y)}
+
+    @property
+    def freqs(self) -> np.ndarray:
+        return self.arrays["freqs"]
+
+    @property
+    def data(self) -> np.ndarray:
+        return self.arrays["data"]
+
+    @property
+    def mask(self) -> np.ndarray:
+        return self.arrays["mask"]
+
+    @property
+    def shape(self) -> tuple:
+        return self.data.shape
+
+    @property
+    def traces(self) -> list:
+        return self.metadata.get("traces", [])
+
+    def trace(self, name: str) -> np.ndarray:
+        # scans of a single trace only know it by the detector name
+        traces = self.traces or [self.metadata.get("detector")]
+        if name not in traces:
+            available = ", ".join(str(t) for t in traces)
+            raise KeyError(f"Scan has no trace {name}, available traces: {available}")
+        return self.arrays[trace_array_name(traces, name)]
+
+    def index_of(self, x_pos: float, y_pos: float) -> tuple:
+        try:
+            return self._x_index[float(x_pos)], self._y_index[float(y_pos)]
+        except KeyError:
+            raise KeyError(f"Point x={x_pos}, y={y_pos} is not on the scan grid")
+
+    def write_point(self, x_pos: float, y_pos: float, trace: np.ndarray) -> None:
+        # a 2-D trace holds one row per trace of the scan
+        i, j = self.index_of(x_pos, y_pos)
+        if np.ndim(trace) == 2:
+            for name, row in zip(self.traces, trace):
+                self.arrays[trace_array_name(self.traces, name)][i, j, :] = row
+        else:
+            self.data[i, j, :] = trace
+        self.mask[i, j] = 1
+
+
+class ScanFile(Scan):
+    def __init__(self, path: str, header: dict, mode: str):
+        self.path = path
+        self.header = header
+        self.mode = mode
+        arrays = {
+            name: np.memmap(
+                path,
+                dtype=np.dtype(desc["dtype"]),
+                mode=mode,
+                offset=desc["offset"],
+                shape=tuple(desc["shape"]),
+            )
+            for name, desc in header["arrays"].items()
+        }
+        super().__init__(header["x"], header["y"], arrays, header["metadata"])
+
+    def flush(self) -> None:
+        for array in self.arrays.values():
+            if isinstance(array, np.memmap) and self.mode != "r":
+                array.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self.arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _array_table(shapes: dict, dtypes: dict, start: int) -> dict:
+    table = {}
+    offset = start
+    for name, shape in shapes.items():
+        dtype = np.dtype(dtypes[name])
+        table[name] = {"dtype": dtype.str, "shape": list(shape), "offset": offset}
+        offset = _align(offset + int(np.prod(shape)) * dtype.itemsize)
+    return table
+
+
+def _encode_header(header: dict) -> bytes:
+    return json.dumps(header).encode("utf-8")
+
+
+def create_scan(
+    path: str,
+    x: np.ndarray,
+    y: np.ndarray,
+    freqs: np.ndarray,
+    metadata: Optional[dict] = None,
+    traces: Optional[list] = None,
+) -> ScanFile:
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    freqs = np.asarray(freqs, dtype=np.float64)
+    metadata = dict(metadata or {})
+    if traces:
+        metadata["traces"] = list(traces)
+    shapes = {
+        "freqs": (len(freqs),),
+        "mask": (len(x), len(y)),
+        "data": (len(x), len(y), len(freqs)),
+    }
+    dtypes = {"freqs": np.float64, "mask": np.uint8, "data": np.float32}
+    for name in (traces or [])[1:]:
+        shapes[TRACE_PREFIX + name] = shapes["data"]
+        dtypes[TRACE_PREFIX + name] = np.float32
+    header = {
+        "version": VERSION,
+        "metadata": metadata,
+        "x": x.tolist(),
+        "y": y.tolist(),
+        "arrays": {},
+    }
+    # the array offsets are part of the header, so size the header region with
+    # a placeholder table first and leave room for the longer real offsets
+    header["arrays"] = _array_table(shapes, dtypes, 0)
+    header_size = _align(len(MAGIC) + 4 + len(_encode_header(header)) + ALIGNMENT)
+    header["arrays"] = _array_table(shapes, dtypes, header_size)
+    encoded = _encode_header(header)
+    end = max(
+        desc["offset"] + int(np.prod(desc["shape"])) * np.dtype(desc["dtype"]).itemsize
+        for desc in header["arrays"].values()
+    )
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(encoded).to_bytes(4, "little"))
+        f.write(encoded)
+        f.truncate(end)
+    scan = ScanFile(path, header, "r+")
+    scan.freqs[:] = freqs
+    scan.flush()
+    return scan
+
+
+def read_header(path: str) -> dict:
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a scan file")
+        size = int.from_bytes(f.read(4), "little")
+        header = json.loads(f.read(size).decode("utf-8"))
+    if header.get("version", 0) > VERSION:
+        raise ValueError(
+            f"{path} uses unsupported scan file version {header['version']}"
+        )
+    return header
+
+
+def open_scan(path: str, mode: str = "r") -> ScanFile:
+    return ScanFile(path, read_header(path), mode)
+
+
+def list_point_files(folder_path: str) -> list:
+    points = []
+    for file in os.listdir(folder_path):
+        coords = parse_point_name(file)
+        if coords is not None:
+            points.append((coords[0], coords[1], file))
+    return points
+
+
+def source_fingerprint(path: str) -> str:
+    # identifies a measurement by its files' names, sizes and modification
+    # times, which is enough to notice a re-measured or converted scan
+    digest = hashlib.sha256(os.path.abspath(path).encode("utf-8"))
+    if os.path.isdir(path):
+        entries = sorted(
+            (p[2], os.stat(os.path.join(path, p[2]))) for p in list_point_files(path)
+        )
+    else:
+        entries = [(os.path.basename(path), os.stat(path))]
+    for name, stat in entries:
+        digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def read_trace_names(file_path: str) -> list:
+    # files of several traces name them in the header, "f[Hz], POS[dB], RMS[dB]"
+    with open(file_path, encoding="utf-8") as f:
+        header = f.readline()
+    if not header.startswith("#"):
+        return []
+    columns = [column.strip() for column in header[1:].split(",")]
+    if len(columns) <= 2:
+        return []
+    return [column.split("[")[0].strip() for column in columns[1:]]
+
+
+def _read_traces(folder_path: str, files: list, count: int = 1) -> np.ndarray:
+    # (file, trace, frequency) when the files hold several traces
+    return np.stack(
+        [
+            np.loadtxt(
+                os.path.join(folder_path, file),
+                delimiter=",",
+                usecols=1 if count == 1 else range(1, count + 1),
+                dtype=np.float32,
+            ).T
+            for file in files
+        ]
+    )
+
+
+def read_csv_dir(folder_path: str, workers: Optional[int] = None) -> Scan:
+    points = list_point_files(folder_path)
+    if not points:
+        raise ValueError(f"No measurement files found in {folder_path}")
+    x = np.array(sorted({p[0] for p in points}))
+    y = np.array(sorted({p[1] for p in points}))
+    # every file of a scan shares the same frequency column, read it only once
+    freqs = np.loadtxt(
+        os.path.join(folder_path, points[0][2]),
+        delimiter=",",
+        usecols=0,
+        dtype=np.float64,
+    )
+    xi = np.searchsorted(x, [p[0] for p in points])
+    yi = np.searchsorted(y, [p[1] for p in points])
+    files = [p[2] for p in points]
+    traces = read_trace_names(os.path.join(folder_path, points[0][2]))
+    count = max(1, len(traces))
+
+    workers = workers or os.cpu_count() or 1
+    chunk_size = max(1, -(-len(files) // (workers * 4)))
+    chunks = [
+        slice(start, start + chunk_size) for start in range(0, len(files), chunk_size)
+    ]
+    data = np.zeros((count, len(x), len(y), len(freqs)), dtype=np.float32)
+    mask = np.zeros((len(x), len(y)), dtype=np.uint8)
+    if workers == 1 or len(chunks) == 1:
+        results = (_read_traces(folder_path, files[chunk], count) for chunk in chunks)
+        _fill_cube(data, mask, xi, yi, chunks, results, folder_path)
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = pool.map(
+                _read_traces,
+                [folder_path] * len(chunks),
+                [files[chunk] for chunk in chunks],
+                [count] * len(chunks),
+            )
+            _fill_cube(data, mask, xi, yi, chunks, results, folder_path)
+    arrays = {"freqs": freqs, "mask": mask, "data": data[0]}
+    metadata = {"source": os.path.abspath(folder_path)}
+    if traces:
+        metadata["traces"] = traces
+        metadata["detector"] = traces[0]
+        for name, cube in zip(traces[1:], data[1:]):
+            arrays[TRACE_PREFIX + name] = cube
+    return Scan(x, y, arrays, metadata)
+
+
+def _fill_cube(data, mask, xi, yi, chunks, results, folder_path) -> None:
+    for chunk, traces in zip(chunks, results):
+        if traces.shape[-1] != data.shape[-1]:
+            raise ValueError(
+                f"Measurement files in {folder_path} have different trace lengths"
+            )
+        if traces.ndim == 2:
+            data[0, xi[chunk], yi[chunk]] = traces
+        else:
+            data[:, xi[chunk], yi[chunk]] = np.moveaxis(traces, 1, 0)
+        mask[xi[chunk], yi[chunk]] = 1
+
+
+def copy_scan(scan: Scan, path: str, metadata: Optional[dict] = None) -> ScanFile:
+    stored = create_scan(
+        path,
+        scan.x,
+        scan.y,
+        scan.freqs,
+        {**scan.metadata, **(metadata or {})},
+        scan.traces,
+    )
+    for name, array in scan.arrays.items():
+        if name != "freqs":
+            stored.arrays[name][:] = array
+    stored.flush()
+    return stored
+
+
+def import_csv_dir(
+    folder_path: str,
+    path: str,
+    metadata: Optional[dict] = None,
+    workers: Optional[int] = None,
+) -> ScanFile:
+    return copy_scan(read_csv_dir(folder_path, workers), path, metadata)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="emi scan import",
+        description="Convert a directory of per-point CSV measurements into a single scan file.",
+    )
+    parser.add_argument("PATH", type=str, help="Path to measurement files")
+    parser.add_argument(
+        "OUTPUT",
+        type=str,
+        help=f"Path of the scan file to create, conventionally with the {SCAN_SUFFIX} suffix",
+    )
+    parser.add_argument(
+        "-u",
+        "--units",
+        type=str,
+        help="Unit of the measurement stored in the scan metadata",
+    )
+    parser.add_argument(
+        "-d",
+        "--detectors",
+        type=str,
+        help="Peak detector used for the measurement stored in the scan metadata",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help="Number of processes parsing the CSV files. Default is the number of CPUs",
+    )
+    args = parser.parse_args()
+    if not os.path.isdir(args.PATH):
+        print(f"Path doesn't exist {args.PATH}")
+        sys.exit()
+    metadata = {}
+    if args.units is not None:
+        metadata["units"] = args.units
+    if args.detectors is not None:
+        metadata["detector"] = args.detectors
+    with import_csv_dir(args.PATH, args.OUTPUT, metadata, args.workers) as scan:
+        print(
+            f"Imported {int(scan.mask.sum())} points "
+            f"({len(scan.x)}x{len(scan.y)} grid, {len(scan.freqs)} frequencies) into {Path(args.OUTPUT)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+from scan_path import format_duration
+
+JOURNAL_NAME = "journal.jsonl"
+
+# The journal is a JSON lines file next to the measurement data. Its first
+# record holds the scan parameters and the home position, followed by a "move"
+# record before the plotter is sent anywhere and a "point" record once the
+# point's data has been synced to disk by the writer. Every record is synced
+# to disk before the scan continues, so after a crash the journal knows which
+# points are complete and where the probe was last sent.
+
+
+class ScanJournal:
+    def __init__(self, path: str, params: dict, home: list, records: list):
+        self.path = path
+        self.params = params
+        self.home = home
+        self.points = {}
+        self.last_move = None
+        self.durations = []
+        for record in records:
+            self._apply(record)
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+        self.session_start = time.monotonic()
+        self.session_points = 0
+
+    def _apply(self, record: dict) -> None:
+        if record["type"] == "move":
+            self.last_move = [record["x"], record["y"], record["z"]]
+        elif record["type"] == "point":
+            self.points[(record["x"], record["y"])] = record
+            self.durations.append(record["duration"])
+
+    def _append(self, record: dict) -> None:
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self._apply(record)
+
+    def record_move(self, x_pos: float, y_pos: float, z_pos: float) -> None:
+        self._append({"type": "move", "x": x_pos, "y": y_pos, "z": z_pos})
+
+    def record_point(self, x_pos: float, y_pos: float, record: dict) -> None:
+        self._append({"type": "point", "x": x_pos, "y": y_pos, **record})
+        self.session_points += 1
+
+    def is_done(self, x_pos: float, y_pos: float) -> bool:
+        return (x_pos, y_pos) in self.points
+
+    def time_per_point(self) -> Optional[float]:
+        # wall time of this session covers the pipelined stages as well, fall
+        # back on the recorded per-point times until there is enough of it
+        if self.session_points >= 3:
+            return (time.monotonic() - self.session_start) / self.session_points
+        if self.durations:
+            return sum(self.durations) / len(self.durations)
+        return None
+
+    def progress(self, done: int, total: int) -> str:
+        # done counts the points measured so far, total those of the plan
+        remaining = total - done
+        per_point = self.time_per_point()
+        status = f"Point {done}/{total} ({done / max(total, 1):.0%})"
+        if per_point is not None:
+            status += f", {per_point:.1f} s/point, ETA {format_duration(per_point * remaining)}"
+        return status
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def create_journal(path_dir: str, params: dict, home: list) -> ScanJournal:
+    path = os.path.join(path_dir, JOURNAL_NAME)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"type": "scan", "params": params, "home": home}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    return ScanJournal(path, params, home, [])
+
+
+def load_journal(path_dir: str) -> ScanJournal:
+    path = os.path.join(path_dir, JOURNAL_NAME)
+    records = []
+    valid = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+            valid += len(line)
+    # drop a record cut short by the crash, so new records start on a new line
+    if valid != os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(valid)
+    if not records or records[0]["type"] != "scan":
+        raise ValueError(f"{path} doesn't start with the scan parameters")
+    header = records[0]
+    return ScanJournal(path, header["params"], header["home"], records[1:])
+
+
+def journal_exists(path_dir: str) -> bool:
+    return os.path.exists(os.path.join(path_dir, JOURNAL_NAME))
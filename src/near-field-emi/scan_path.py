@@ -0,0 +1,183 @@
+import argparse
+from typing import Optional
+
+import numpy as np
+
+# feed rate used by the estimates when the plotter's one isn't given, in mm/min
+DEFAULT_FEEDRATE = 3000.0
+
+
+def grid_points(x_positions, y_positions) -> np.ndarray:
+    x, y = np.meshgrid(
+        np.asarray(x_positions, dtype=np.float64),
+        np.asarray(y_positions, dtype=np.float64),
+        indexing="ij",
+    )
+    return np.stack((x.reshape(-1), y.reshape(-1)), axis=1)
+
+
+def raster_path(points: np.ndarray, start: Optional[np.ndarray] = None) -> np.ndarray:
+    # column by column, every column starting again from the lowest y
+    return points[np.lexsort((points[:, 1], points[:, 0]))]
+
+
+def serpentine_path(
+    points: np.ndarray, start: Optional[np.ndarray] = None
+) -> np.ndarray:
+    # column by column, reversing the direction of y on every other column
+    _, column = np.unique(points[:, 0], return_inverse=True)
+    direction = np.where(column % 2 == 0, 1.0, -1.0)
+    return points[np.lexsort((points[:, 1] * direction, points[:, 0]))]
+
+
+def nearest_path(points: np.ndarray, start: Optional[np.ndarray] = None) -> np.ndarray:
+    position = points[0] if start is None else np.asarray(start, dtype=np.float64)
+    remaining = np.ones(len(points), dtype=bool)
+    order = np.empty(len(points), dtype=np.int64)
+    for n in range(len(points)):
+        distances = np.hypot(*(points - position).T)
+        distances[~remaining] = np.inf
+        nearest = int(np.argmin(distances))
+        order[n] = nearest
+        remaining[nearest] = False
+        position = points[nearest]
+    return points[order]
+
+
+def tsp_path(
+    points: np.ndarray, start: Optional[np.ndarray] = None, max_passes: int = 20
+) -> np.ndarray:
+    # nearest neighbour tour improved with 2-opt moves, the probe starts and
+    # ends at the start position so both ends of the route are fixed
+    path = nearest_path(points, start)
+    anchor = path[0] if start is None else np.asarray(start, dtype=np.float64)
+    route = np.concatenate(([anchor], path, [anchor]))
+    for _ in range(max_passes):
+        improved = False
+        for i in range(len(route) - 3):
+            a, b = route[i], route[i + 1]
+            c, d = route[i + 2 : -1], route[i + 3 :]
+            gain = (
+                np.hypot(*(a - b))
+                + np.hypot(*(c - d).T)
+                - np.hypot(*(a - c).T)
+                - np.hypot(*(b - d).T)
+            )
+            best = int(np.argmax(gain))
+            if gain[best] > 1e-9:
+                j = i + 2 + best
+                route[i + 1 : j + 1] = route[i + 1 : j + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return route[1:-1]
+
+
+path_planners = {
+    "raster": raster_path,
+    "serpentine": serpentine_path,
+    "nearest": nearest_path,
+    "tsp": tsp_path,
+}
+
+
+def plan_path(
+    points: np.ndarray, planner: str, start: Optional[np.ndarray] = None
+) -> np.ndarray:
+    return path_planners[planner](np.asarray(points, dtype=np.float64), start)
+
+
+def path_length(
+    path: np.ndarray,
+    start: Optional[np.ndarray] = None,
+    end: Optional[np.ndarray] = None,
+) -> float:
+    route = [np.asarray(path, dtype=np.float64)]
+    if start is not None:
+        route.insert(0, np.asarray(start, dtype=np.float64).reshape(1, 2))
+    if end is not None:
+        route.append(np.asarray(end, dtype=np.float64).reshape(1, 2))
+    route = np.concatenate(route)
+    return float(np.hypot(*np.diff(route, axis=0).T).sum())
+
+
+def estimate_scan_time(
+    path: np.ndarray,
+    feedrate: float = DEFAULT_FEEDRATE,
+    dwell: float = 0.0,
+    start: Optional[np.ndarray] = None,
+    end: Optional[np.ndarray] = None,
+) -> float:
+    # travel at the feed rate plus a fixed time spent at every point, in seconds
+    travel = path_length(path, start, end) / (feedrate / 60.0)
+    return travel + len(path) * dwell
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def plan_summary(
+    points: np.ndarray,
+    planner: str,
+    feedrate: float = DEFAULT_FEEDRATE,
+    dwell: float = 0.0,
+    start: Optional[np.ndarray] = None,
+) -> tuple:
+    path = plan_path(points, planner, start)
+    raster = raster_path(np.asarray(points, dtype=np.float64))
+    length = path_length(path, start, start)
+    raster_length = path_length(raster, start, start)
+    duration = estimate_scan_time(path, feedrate, dwell, start, start)
+    raster_duration = estimate_scan_time(raster, feedrate, dwell, start, start)
+    saving = 1 - length / raster_length if raster_length > 0 else 0.0
+    summary = (
+        f"Path {planner}: {len(path)} points, travel {length:.0f} mm, "
+        f"estimated time {format_duration(duration)} "
+        f"(raster: travel {raster_length:.0f} mm, {format_duration(raster_duration)}, "
+        f"saving {saving:.0%})"
+    )
+    return path, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="emi scan path",
+        description="Compare probe path planners for a measurement grid without moving the hardware.",
+    )
+    parser.add_argument("x", type=int, help="X dimension of the board in mm")
+    parser.add_argument("y", type=int, help="Y dimension of the board in mm")
+    parser.add_argument(
+        "-s",
+        "--step",
+        type=int,
+        nargs=2,
+        help="Set a measurement step in mm, x, y. Default is 5 5",
+        default=[5, 5],
+    )
+    parser.add_argument(
+        "--feedrate",
+        type=float,
+        help=f"Plotter feed rate in mm/min used for time estimates. Default is {DEFAULT_FEEDRATE:.0f}",
+        default=DEFAULT_FEEDRATE,
+    )
+    parser.add_argument(
+        "--dwell",
+        type=float,
+        help="Time spent at every point in seconds. Default is 3",
+        default=3.0,
+    )
+    args = parser.parse_args()
+    points = grid_points(
+        [args.step[0] * x for x in range(int(args.x / args.step[0]))],
+        [args.step[1] * y for y in range(int(args.y / args.step[1]))],
+    )
+    for planner in path_planners:
+        _, summary = plan_summary(points, planner, args.feedrate, args.dwell, (0, 0))
+        print(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import time
+from typing import Optional
+
+import numpy as np
+
+from acquisition import parse_blocks
+from control.SA import (
+    query_sweep_points,
+    query_sweep_time,
+    set_frequency_span,
+    set_RBW,
+)
+
+# A wide span is swept as consecutive sub-spans, each returning the full
+# number of sweep points, which multiplies the frequency resolution by the
+# number of segments. Neighbouring segments share their edge frequency, so the
+# stitched spectrum drops the first point of every segment after the first and
+# stays evenly spaced from the start to the stop of the whole span. Points
+# sweep the segments in alternating order, a point starts with the segment the
+# previous one ended with and the SA is retuned once less per point.
+
+
+def plan_segments(start: float, stop: float, count: int) -> list:
+    edges = np.linspace(start, stop, count + 1)
+    return [(float(low), float(high)) for low, high in zip(edges[:-1], edges[1:])]
+
+
+def stitched_points(count: int, points: int) -> int:
+    return count * (points - 1) + 1
+
+
+def stitch_segments(spectra: list) -> np.ndarray:
+    # spectra of the segments in frequency order, a row per trace if 2-D
+    return np.concatenate(
+        [spectra[0]] + [spectrum[..., 1:] for spectrum in spectra[1:]], axis=-1
+    )
+
+
+def format_frequency(value: float) -> str:
+    for unit, scale in (("GHz", 1e9), ("MHz", 1e6), ("kHz", 1e3)):
+        if abs(value) >= scale:
+            return f"{value / scale:.3g} {unit}"
+    return f"{value:.3g} Hz"
+
+
+class SegmentedSweep:
+    def __init__(
+        self, instr, start: float, stop: float, count: int, rbw: Optional[float]
+    ):
+        self.instr = instr
+        self.start = start
+        self.stop = stop
+        self.segments = plan_segments(start, stop, count)
+        self.current = None
+        self.forward = True
+        self.tuning = 0.0
+        # the RBW is left coupled to the span when it isn't given
+        if rbw is not None:
+            set_RBW(instr, rbw)
+        self.sweep_times = []
+        for index in range(len(self.segments)):
+            self.select(index)
+            self.sweep_times.append(query_sweep_time(instr))
+        self.points = query_sweep_points(instr)
+
+    def select(self, index: int) -> None:
+        if index == self.current:
+            return
+        started = time.monotonic()
+        set_frequency_span(self.instr, *self.segments[index])
+        self.current = index
+        self.tuning += time.monotonic() - started
+
+    def order(self) -> list:
+        indices = list(range(len(self.segments)))
+        if not self.forward:
+            indices.reverse()
+        self.forward = not self.forward
+        return indices
+
+    def sweep(self, read) -> np.ndarray:
+        # read(sweep_time) triggers a sweep of the selected segment and
+        # returns its blocks
+        spectra = [None] * len(self.segments)
+        for index in self.order():
+            self.select(index)
+            spectra[index] = parse_blocks(read(self.sweep_times[index]))
+        return stitch_segments(spectra)
+
+    def sweep_time(self) -> float:
+        return sum(self.sweep_times)
+
+    def summary(self) -> str:
+        width = (self.stop - self.start) / len(self.segments)
+        points = stitched_points(len(self.segments), self.points)
+        bin_width = (self.stop - self.start) / (points - 1)
+        return (
+            f"Segmented sweep: {len(self.segments)} segments of {format_frequency(width)}, "
+            f"{points} points with {format_frequency(bin_width)} bins, "
+            f"{self.sweep_time():.2f} s sweeping and "
+            f"{len(self.segments) - 1} retunes per point"
+        )
@@ -0,0 +1,234 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from typing import Optional
+
+import numpy as np
+
+from scan_file import SCAN_SUFFIX, Scan, copy_scan, is_scan_file, open_scan
+from scan_path import format_duration
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "emi-near-field-collector"
+)
+DEFAULT_CACHE_SIZE = 2 << 30
+# bump when a stage's results change, so entries of older versions are missed
+CACHE_VERSION = 1
+PARTIAL_SUFFIX = ".part"
+
+# Results of the processing stages are stored under <cache>/<stage>/<key>,
+# where the key hashes the fingerprints of the input files (their names,
+# sizes and modification times, not their content) with the parameters and
+# constants of the stage and of every stage before it. Entries are written
+# under a temporary name and renamed once complete, and their modification
+# time is bumped on every hit, so the least recently used entries can be
+# evicted once the cache grows over its size limit.
+
+
+def stage_key(*parts) -> str:
+    digest = hashlib.sha256(f"v{CACHE_VERSION}".encode("utf-8"))
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(json.dumps(part, default=float).encode("utf-8"))
+        digest.update(b";")
+    return digest.hexdigest()
+
+
+class StageCache:
+    def __init__(
+        self, root: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_SIZE
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def path(self, stage: str, key: str, suffix: str) -> str:
+        return os.path.join(self.root, stage, key + suffix)
+
+    def _hit(self, path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        os.utime(path)
+        return True
+
+    def _partial(self, path: str) -> str:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return f"{path}.{os.getpid()}{PARTIAL_SUFFIX}"
+
+    def _commit(self, partial: str, path: str) -> None:
+        os.replace(partial, path)
+        self.evict(keep=path)
+
+    def scan(self, stage: str, key: str, compute) -> Scan:
+        path = self.path(stage, key, SCAN_SUFFIX)
+        if self._hit(path) and is_scan_file(path):
+            return open_scan(path)
+        scan = compute()
+        partial = self._partial(path)
+        with copy_scan(scan, partial):
+            pass
+        self._commit(partial, path)
+        return open_scan(path)
+
+    def array(self, stage: str, key: str, compute) -> np.ndarray:
+        path = self.path(stage, key, ".npy")
+        if self._hit(path):
+            return np.load(path)
+        array = compute()
+        partial = self._partial(path)
+        with open(partial, "wb") as f:
+            np.save(f, array)
+        self._commit(partial, path)
+        return array
+
+    def bands(self, stage: str, key: str, shape: tuple, compute):
+        # a generator storing the bands into the entry while passing them on,
+        # so a cube larger than memory can be cached; an entry is only
+        # committed once every band has gone through
+        path = self.path(stage, key, ".npy")
+        if self._hit(path):
+            yield from np.load(path, mmap_mode="r")
+            return
+        partial = self._partial(path)
+        stored = np.lib.format.open_memmap(partial, "w+", np.float32, shape)
+        try:
+            for i, band in enumerate(compute()):
+                stored[i] = band
+                # committed before the last band is passed on, consumers like
+                # zip() don't ask the generator for its end
+                if i + 1 == shape[0]:
+                    stored.flush()
+                    del stored
+                    self._commit(partial, path)
+                yield band
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def entries(self) -> list:
+        # (stage, file name, size in bytes, last use) sorted from the oldest
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for stage in sorted(os.listdir(self.root)):
+            stage_dir = os.path.join(self.root, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for name in os.listdir(stage_dir):
+                stat = os.stat(os.path.join(stage_dir, name))
+                entries.append((stage, name, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[3])
+
+    def size(self) -> int:
+        return sum(entry[2] for entry in self.entries())
+
+    def evict(self, keep: Optional[str] = None) -> list:
+        entries = self.entries()
+        total = sum(entry[2] for entry in entries)
+        evicted = []
+        for stage, name, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            path = os.path.join(self.root, stage, name)
+            # entries being written by another run are left alone
+            if path == keep or name.endswith(PARTIAL_SUFFIX):
+                continue
+            os.remove(path)
+            total -= size
+            evicted.append(path)
+        return evicted
+
+    def clear(self, stage: Optional[str] = None) -> int:
+        removed = 0
+        for entry_stage, name, size, _ in self.entries():
+            if stage is None or entry_stage == stage:
+                os.remove(os.path.join(self.root, entry_stage, name))
+                removed += size
+        return removed
+
+
+def cached_scan(cache: Optional[StageCache], stage: str, key: str, compute) -> Scan:
+    return compute() if cache is None else cache.scan(stage, key, compute)
+
+
+def cached_array(
+    cache: Optional[StageCache], stage: str, key: str, compute
+) -> np.ndarray:
+    return compute() if cache is None else cache.array(stage, key, compute)
+
+
+def cached_bands(cache: Optional[StageCache], stage: str, key: str, shape, compute):
+    return compute() if cache is None else cache.bands(stage, key, shape, compute)
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "kB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="emi stage cache",
+        description="Inspect or clear the cache of intermediate data_process.py results.",
+    )
+    parser.add_argument(
+        "command",
+        type=str,
+        choices=["list", "clear"],
+        help="List the cached entries by stage or remove them",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help=f"Cache directory. Default is {DEFAULT_CACHE_DIR}",
+        default=DEFAULT_CACHE_DIR,
+    )
+    parser.add_argument(
+        "--stage",
+        type=str,
+        help="Only list or clear the entries of this stage",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="List every entry with its size and last use",
+    )
+    args = parser.parse_args()
+    if not os.path.isdir(args.cache_dir):
+        print(f"No cache in {args.cache_dir}")
+        sys.exit()
+    cache = StageCache(args.cache_dir)
+    if args.command == "clear":
+        removed = cache.clear(args.stage)
+        print(f"Removed {format_size(removed)} from {args.cache_dir}")
+        return
+    now = time.time()
+    stages = {}
+    for stage, name, size, used in cache.entries():
+        if args.stage is not None and stage != args.stage:
+            continue
+        count, total, last = stages.get(stage, (0, 0, 0))
+        stages[stage] = (count + 1, total + size, max(last, used))
+        if args.verbose:
+            print(
+                f"{stage:>14} {name[:16]:<16} {format_size(size):>10} {format_duration(now - used)} ago"
+            )
+    print(f"{'stage':>14} {'entries':>8} {'size':>10} {'last used':>12}")
+    for stage, (count, total, last) in sorted(stages.items()):
+        print(
+            f"{stage:>14} {count:>8} {format_size(total):>10} {format_duration(now - last):>12}"
+        )
+    print(
+        f"{'total':>14} {sum(s[0] for s in stages.values()):>8} {format_size(sum(s[1] for s in stages.values())):>10}"
+    )
+
+
+if __name__ == "__main__":
+    main()
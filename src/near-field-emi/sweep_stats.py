@@ -0,0 +1,62 @@
+import numpy as np
+
+STATISTICS = ["max", "min", "var"]
+# variance estimates from fewer sweeps are too noisy to compare
+MIN_SWEEPS = 3
+
+# Repeated sweeps at a point are reduced as they arrive with Welford's
+# algorithm, so only the running mean, the sum of squared deviations and the
+# extremes are kept however many sweeps are taken. The mean is taken of the
+# levels as read, i.e. of dB values, like the log power average of an SA.
+# Statistics are stored as extra traces named <trace>:<statistic>, the mean
+# keeps the trace's own name.
+
+
+def statistic_traces(traces: list) -> list:
+    return list(traces) + [
+        f"{trace}:{statistic}" for statistic in STATISTICS for trace in traces
+    ]
+
+
+class SweepStatistics:
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.max = None
+        self.min = None
+        self.previous_variance = None
+        self.current_variance = None
+
+    def add(self, trace: np.ndarray) -> None:
+        trace = np.asarray(trace, dtype=np.float64)
+        self.count += 1
+        if self.mean is None:
+            self.mean = trace.copy()
+            self.m2 = np.zeros_like(trace)
+            self.max = trace.copy()
+            self.min = trace.copy()
+        else:
+            delta = trace - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (trace - self.mean)
+            np.maximum(self.max, trace, out=self.max)
+            np.minimum(self.min, trace, out=self.min)
+        self.previous_variance = self.current_variance
+        self.current_variance = float(np.mean(self.variance()))
+
+    def variance(self) -> np.ndarray:
+        return self.m2 / max(self.count - 1, 1)
+
+    def converged(self, tolerance: float) -> bool:
+        # the mean variance over the sweep changed by less than the tolerance
+        # with the last sweep
+        if tolerance <= 0 or self.count < MIN_SWEEPS:
+            return False
+        change = abs(self.current_variance - self.previous_variance)
+        return change <= tolerance * max(self.current_variance, np.finfo(float).tiny)
+
+    def result(self) -> np.ndarray:
+        # rows in the order of statistic_traces(), a trace per row of the sweeps
+        rows = [self.mean, self.max, self.min, self.variance()]
+        return np.concatenate([np.atleast_2d(row) for row in rows]).astype(np.float32)
@@ -0,0 +1,65 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+MEASURE = Path(__file__).resolve().parents[1] / "measure.py"
+
+# measure.py run end to end against the simulated plotter and SA
+
+
+def run_scan(target: str, *options: str) -> subprocess.CompletedProcess:
+    command = [
+        sys.executable,
+        str(MEASURE),
+        "20",
+        "20",
+        "simulated",
+        "simulated",
+        target,
+        "--simulate",
+        "--sim-time-scale",
+        "0",
+        "--settle",
+        "0",
+        *options,
+    ]
+    return subprocess.run(command, capture_output=True, text=True, timeout=300)
+
+
+def read_points(path: str) -> list:
+    with open(os.path.join(path, "journal.jsonl"), encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    return [record for record in records if record["type"] == "point"]
+
+
+class SegmentedScanTest(unittest.TestCase):
+    # a stitched sweep of a single detector is a single trace, refinement and
+    # the preview have to take it as well as a trace per detector
+    def check_scan(self, *options: str) -> list:
+        with tempfile.TemporaryDirectory() as target:
+            result = run_scan(target, *options)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            points = read_points(target)
+            self.assertTrue(points)
+            return points
+
+    def test_adaptive(self):
+        for detectors in (["POS"], ["POS", "RMS"]):
+            with self.subTest(detectors=detectors):
+                points = self.check_scan(
+                    "--segments", "2", "--adaptive", "-d", *detectors
+                )
+                self.assertTrue(all("level" in point for point in points))
+
+    def test_preview(self):
+        for detectors in (["POS"], ["POS", "RMS"]):
+            with self.subTest(detectors=detectors):
+                self.check_scan("--segments", "2", "--preview", "png", "-d", *detectors)
+
+
+if __name__ == "__main__":
+    unittest.main()